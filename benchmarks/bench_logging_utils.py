@@ -0,0 +1,78 @@
+"""
+Benchmarks for bot_base.utils.logging_utils
+
+python benchmarks/bench_logging_utils.py
+"""
+import io
+import pprint
+import timeit
+
+import loguru
+
+from bot_base.utils.logging_utils import (
+    custom_formatter,
+    data_filter,
+    format_record,
+    no_data_filter,
+    render_data,
+)
+
+logger = loguru.logger
+
+
+def setup_two_sinks(stream):
+    # the previous setup - a sink per filter, data rendered by the caller
+    logger.configure(patcher=None)
+    return [
+        logger.add(stream, level="INFO", filter=no_data_filter),
+        logger.add(stream, level="INFO", filter=data_filter, format=custom_formatter),
+    ]
+
+
+def setup_patcher(stream):
+    logger.configure(patcher=render_data)
+    return [logger.add(stream, level="INFO", format=format_record)]
+
+
+def bench_debug_with_data():
+    print("logger.debug with a large payload, DEBUG discarded")
+    chunks = [f"transcript chunk {i} " * 50 for i in range(200)]
+    number = 1000
+    logger.remove()
+    for name, setup, log in [
+        (
+            "two sinks",
+            setup_two_sinks,
+            lambda: logger.debug("Parsed audio", data=pprint.pformat(chunks)),
+        ),
+        (
+            "patcher",
+            setup_patcher,
+            lambda: logger.debug("Parsed audio", data=lambda: pprint.pformat(chunks)),
+        ),
+    ]:
+        handler_ids = setup(io.StringIO())
+        seconds = timeit.timeit(log, number=number)
+        print(f"{name:>10}: {seconds / number * 1e6:10.2f} us")
+        for handler_id in handler_ids:
+            logger.remove(handler_id)
+
+
+def bench_info_with_data():
+    print("logger.info with data, written")
+    data = "message text " * 500
+    number = 10_000
+    logger.remove()
+    for name, setup in [("two sinks", setup_two_sinks), ("patcher", setup_patcher)]:
+        handler_ids = setup(io.StringIO())
+        seconds = timeit.timeit(
+            lambda: logger.info("Received message", data=data), number=number
+        )
+        print(f"{name:>10}: {seconds / number * 1e6:10.2f} us")
+        for handler_id in handler_ids:
+            logger.remove(handler_id)
+
+
+if __name__ == "__main__":
+    bench_debug_with_data()
+    bench_info_with_data()
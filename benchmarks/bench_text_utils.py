@@ -0,0 +1,84 @@
+"""
+Benchmarks for bot_base.utils.text_utils
+
+python benchmarks/bench_text_utils.py
+"""
+import random
+import timeit
+
+from bot_base.utils.text_utils import (
+    MAX_TELEGRAM_MESSAGE_LENGTH,
+    escape_md,
+    iter_split_long_message,
+    stitch_transcripts,
+)
+
+
+def make_transcript_chunks(n_words, chunk_size=300, overlap=15, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(1000)]
+    words = [rng.choice(vocabulary) for _ in range(n_words)]
+    chunks = []
+    start = 0
+    while True:
+        end = min(start + chunk_size, n_words)
+        chunks.append(" ".join(words[start:end]))
+        if end == n_words:
+            return chunks
+        start = end - overlap
+
+
+def bench_stitch_transcripts():
+    print("stitch_transcripts - synthetic chunks with 15 overlapping words")
+    for n_words in [10_000, 100_000, 1_000_000]:
+        chunks = make_transcript_chunks(n_words)
+        number = 5
+        seconds = timeit.timeit(lambda: stitch_transcripts(chunks), number=number)
+        print(f"{n_words:>10} words: {seconds / number * 1000:8.2f} ms")
+
+
+def split_long_message_slicing(text, max_length=MAX_TELEGRAM_MESSAGE_LENGTH, sep="\n"):
+    # the previous implementation - re-copies the rest of the text on each step
+    chunks = []
+    while len(text) > max_length:
+        chunk = text[:max_length]
+        if sep:
+            last_sep = chunk.rfind(sep)
+            if last_sep != -1:
+                chunk = chunk[: last_sep + 1]
+        text = text[len(chunk) :]
+        chunks.append(chunk)
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def make_long_message(n_chars, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    size = 0
+    while size < n_chars:
+        line = escape_md(" ".join(f"word{rng.randint(0, 999)}." for _ in range(12)))
+        if rng.random() < 0.05:
+            line = "```\n" + line + "\n```"
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def bench_split_long_message():
+    print("split_long_message - escaped text with code blocks")
+    for n_chars in [100_000, 1_000_000, 10_000_000]:
+        text = make_long_message(n_chars)
+        number = 3
+        for name, func in [
+            ("slicing", split_long_message_slicing),
+            ("index-based", lambda text: list(iter_split_long_message(text))),
+        ]:
+            seconds = timeit.timeit(lambda: func(text), number=number)
+            print(f"{n_chars:>10} chars, {name:>11}: {seconds / number * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    bench_stitch_transcripts()
+    bench_split_long_message()
@@ -13,11 +13,13 @@ from bot_base.core import DatabaseConfig, TelegramBotConfig
 from bot_base.core.app_config import AppConfig
 from bot_base.core.telegram_bot import TelegramBot
 from bot_base.utils.audio_utils import (
-    DEFAULT_PERIOD,
     DEFAULT_BUFFER,
+    get_encoding_executor,
     split_and_transcribe_audio,
 )
-from bot_base.utils.gpt_utils import Audio
+from bot_base.utils.async_utils import FairScheduler
+from bot_base.utils.cache_utils import LRUCache, MongoCache, TieredCache
+from bot_base.utils.gpt_utils import Audio, set_completion_cache
 
 
 class AppBase:
@@ -68,6 +70,18 @@ class AppBase:
         self.logger.info(f"Starting {self.__class__.__name__}")
         asyncio.run(self.bot.run())
 
+    def run_sharded(self, num_workers: int = None):
+        """
+        Run the bot on several processes, updates are sharded by chat id
+        Each worker process creates its own app of the same class
+        """
+        from bot_base.core.sharding import ShardSupervisor
+
+        if num_workers is None:
+            num_workers = self.config.shard_workers
+        self.logger.info(f"Starting {self.__class__.__name__} sharded")
+        asyncio.run(ShardSupervisor(self, num_workers=num_workers).run())
+
 
 class App(AppBase):
     def __init__(self, data_dir=None, config: AppConfig = None):
@@ -80,6 +94,13 @@ class App(AppBase):
         if self.config.enable_voice_recognition:
             self.logger.info("Initializing voice recognition")
             self._init_voice_recognition()
+        self.transcription_cache = self._init_transcription_cache()
+        self.completion_cache = self._init_completion_cache()
+        # shared by all chats of the bot
+        self.transcription_scheduler = FairScheduler(
+            max_concurrency=self.config.transcription_max_concurrency,
+            max_queue_per_key=self.config.transcription_queue_per_chat,
+        )
 
         self._scheduler = None
         if self.config.enable_scheduler:
@@ -105,6 +126,23 @@ class App(AppBase):
 
     # ------------------ GPT Engine ------------------ #
 
+    def _init_completion_cache(self):
+        persistent = None
+        if self.config.completion_cache_persistent:
+            persistent = MongoCache(
+                "completions",
+                max_size=self.config.completion_cache_persistent_size,
+                ttl=self.config.completion_cache_ttl,
+            )
+        memory = LRUCache(
+            max_size=self.config.completion_cache_size,
+            ttl=self.config.completion_cache_ttl,
+        )
+        cache = TieredCache(memory, persistent)
+        # gpt_utils helpers are module-level - the cache is process-wide
+        set_completion_cache(cache)
+        return cache
+
     # ------------------ Audio ------------------ #
 
     def _init_voice_recognition(self):
@@ -114,21 +152,53 @@ class App(AppBase):
         # todo: check pyrogram token and api_id
         pass
 
+    def _init_transcription_cache(self):
+        persistent = None
+        if self.config.transcription_cache_persistent:
+            persistent = MongoCache(
+                "transcriptions",
+                max_size=self.config.transcription_cache_persistent_size,
+                ttl=self.config.transcription_cache_ttl,
+            )
+        memory = LRUCache(
+            max_size=self.config.transcription_cache_size,
+            ttl=self.config.transcription_cache_ttl,
+        )
+        return TieredCache(memory, persistent)
+
     async def parse_audio(
         self,
         audio: Audio,
-        period: int = DEFAULT_PERIOD,
+        period: int = None,
         buffer: int = DEFAULT_BUFFER,
         parallel: bool = None,
+        streaming: bool = None,
+        pipelined: bool = None,
+        silence_aware: bool = None,
+        chat_id=None,
     ):
         if parallel is None:
             parallel = self.config.process_audio_in_parallel
+        if streaming is None:
+            streaming = self.config.split_audio_streaming
+        if pipelined is None:
+            pipelined = self.config.transcribe_audio_pipelined
+        if silence_aware is None:
+            silence_aware = self.config.split_audio_on_silence
         chunks = await split_and_transcribe_audio(
             audio,
             period=period,
             buffer=buffer,
             parallel=parallel,
             logger=self.logger,
+            streaming=streaming,
+            executor=get_encoding_executor(self.config.audio_encoding_workers),
+            max_workers=self.config.audio_encoding_workers,
+            pipelined=pipelined,
+            cache=self.transcription_cache,
+            silence_aware=silence_aware,
+            scheduler=self.transcription_scheduler,
+            scheduler_key=chat_id,
         )
         return chunks
 
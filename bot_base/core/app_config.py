@@ -1,9 +1,9 @@
 from pathlib import Path
-from typing import Optional
+from typing import Literal, Optional
 
 from aiogram.enums import ParseMode
 from dotenv import load_dotenv
-from pydantic import SecretStr
+from pydantic import SecretStr, model_validator
 from pydantic_settings import BaseSettings
 
 load_dotenv()
@@ -31,10 +31,44 @@ class TelegramBotConfig(BaseSettings):
     parse_mode: Optional[ParseMode] = None
     send_preview_for_long_messages: bool = False
 
+    # large files (>20 MB) are downloaded with pyrogram
+    # in-process mode reuses one long-lived session instead of a subprocess per file
+    download_large_files_in_process: bool = True
+    max_concurrent_downloads: int = 4
+    # large files are fetched as byte-range parts in parallel
+    parallel_download_parts: int = 8
+    parallel_download_per_dc_limit: int = 4
+    parallel_download_part_size_mb: int = 8
+
+    # progressive messages are edited at most once per this many seconds
+    progressive_edit_interval: float = 1.5
+
+    # outgoing messages per second, see telegram's flood limits
+    outbound_global_rate: float = 30
+    outbound_chat_rate: float = 1
+    outbound_group_rate: float = 20 / 60
+
+    # polling or webhook. Webhook mode serves updates with aiohttp
+    # and allows several replicas behind a load balancer
+    run_mode: Literal["polling", "webhook"] = "polling"
+    webhook_url: str = ""  # public base url, e.g. https://bot.example.com
+    webhook_path: str = "/webhook"
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_secret: SecretStr = SecretStr("")
+    webhook_max_concurrent_updates: int = 100  # more get 429, telegram resends
+    webhook_drain_timeout: int = 30  # seconds
+
     model_config = {
         "env_prefix": "TELEGRAM_BOT_",
     }
 
+    @model_validator(mode="after")
+    def check_webhook_url(self):
+        if self.run_mode == "webhook" and not self.webhook_url:
+            raise ValueError("webhook_url is required for run_mode='webhook'")
+        return self
+
 
 DEFAULT_DATA_DIR = "app_data"
 
@@ -52,6 +86,32 @@ class AppConfig(BaseSettings):
     # todo: use this setting
     enable_voice_recognition: bool = False
     process_audio_in_parallel: bool = False
+    # cut chunks with ffmpeg right from the file instead of decoding it whole
+    split_audio_streaming: bool = False
+    # cut chunks in pauses - fewer, fuller whisper requests with no overlap
+    split_audio_on_silence: bool = False
+    # process pool / parallel ffmpeg workers for chunk encoding, cpu count if None
+    audio_encoding_workers: Optional[int] = None
+    # send chunks to whisper as soon as they're encoded
+    transcribe_audio_pipelined: bool = True
+    # transcriptions are cached by telegram file_unique_id and by chunk hash
+    transcription_cache_size: int = 1024
+    transcription_cache_ttl: Optional[int] = 30 * 24 * 60 * 60  # 30 days
+    # also keep transcriptions in the app database
+    transcription_cache_persistent: bool = False
+    transcription_cache_persistent_size: Optional[int] = 100_000
+    # whisper requests in flight across all chats, chats take turns
+    transcription_max_concurrency: int = 8
+    transcription_queue_per_chat: int = 64
+    # gpt command results are cached by a hash of model, command and data
+    completion_cache_size: int = 4096
+    completion_cache_ttl: Optional[int] = 7 * 24 * 60 * 60  # 7 days
+    # also keep completions in the app database
+    completion_cache_persistent: bool = False
+    completion_cache_persistent_size: Optional[int] = 100_000
+
+    # worker processes for run_sharded, cpu count if None
+    shard_workers: Optional[int] = None
 
     # todo: use this setting
     enable_scheduler: bool = False
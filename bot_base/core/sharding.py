@@ -0,0 +1,331 @@
+"""
+Run one bot on several processes: the supervisor receives updates once and
+shards them by chat id across worker processes, each with its own App
+
+app = MyApp()
+app.run_sharded(num_workers=4)
+
+Updates of one chat always go to the same worker and are handled in order,
+so per-chat state (e.g. messages_stack) stays local to its worker
+"""
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import zlib
+from multiprocessing.context import SpawnProcess
+from typing import TYPE_CHECKING, Dict, List, Optional, Type
+
+import loguru
+from aiogram import types
+
+if TYPE_CHECKING:
+    from bot_base.core.app import AppBase
+    from bot_base.core.app_config import AppConfig
+
+POLL_TIMEOUT = 30  # seconds, long polling
+HEARTBEAT_INTERVAL = 1  # seconds
+HEARTBEAT_TIMEOUT = 30  # seconds without a heartbeat - the worker is stuck
+HEALTH_CHECK_INTERVAL = 5  # seconds
+SHUTDOWN_TIMEOUT = 30  # seconds
+QUEUE_SIZE = 1000  # updates waiting per worker
+MAX_CONCURRENT_UPDATES = 100  # per worker
+MAX_PENDING_UPDATES = 1000  # per worker, incl. the ones waiting for their chat
+POLL_RETRY_DELAY = 1  # seconds, doubled on each failure
+POLL_RETRY_MAX_DELAY = 30
+QUEUE_POLL_INTERVAL = 1  # seconds, how often a worker checks for shutdown
+
+# update fields that carry the chat
+_CHAT_PATHS = [
+    ("message", "chat"),
+    ("edited_message", "chat"),
+    ("channel_post", "chat"),
+    ("edited_channel_post", "chat"),
+    ("callback_query", "message", "chat"),
+    ("my_chat_member", "chat"),
+    ("chat_member", "chat"),
+    ("chat_join_request", "chat"),
+    # no chat - shard by user
+    ("callback_query", "from"),
+    ("inline_query", "from"),
+    ("chosen_inline_result", "from"),
+    ("shipping_query", "from"),
+    ("pre_checkout_query", "from"),
+    ("poll_answer", "user"),
+]
+
+
+def get_update_chat_id(update: dict) -> Optional[int]:
+    """
+    Chat id of a raw update (as sent by telegram), user id if there's no chat
+    """
+    for path in _CHAT_PATHS:
+        value = update
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, dict) and "id" in value:
+            return value["id"]
+    return None
+
+
+def shard_for_update(update: dict, num_shards: int) -> int:
+    """
+    Stable shard of an update: the same chat always gets the same shard
+    """
+    chat_id = get_update_chat_id(update)
+    if chat_id is None:
+        return update.get("update_id", 0) % num_shards
+    return zlib.crc32(str(chat_id).encode()) % num_shards
+
+
+class ChatOrderedRunner:
+    """
+    Handle updates concurrently, but updates of one chat one after another
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_UPDATES,
+        max_pending: int = MAX_PENDING_UPDATES,
+        logger=None,
+    ):
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._pending = asyncio.Semaphore(max_pending)
+        self._last: Dict[Optional[int], asyncio.Task] = {}  # chat id -> last task
+        if logger is None:
+            logger = loguru.logger
+        self.logger = logger
+
+    async def submit(self, chat_id, func, *args):
+        """
+        Schedule func(*args) after the previous job of the chat
+        Waits while max_pending jobs are scheduled
+        """
+        await self._pending.acquire()
+        previous = self._last.get(chat_id)
+        task = asyncio.create_task(self._run(previous, func, *args))
+        self._last[chat_id] = task
+        task.add_done_callback(lambda t: self._forget(chat_id, t))
+        return task
+
+    async def _run(self, previous: Optional[asyncio.Task], func, *args):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            # take a slot only when the job can run - a burst from one chat
+            # doesn't hold the slots while waiting for itself
+            async with self._semaphore:
+                await func(*args)
+        except Exception:
+            self.logger.exception("Failed to process update")
+        finally:
+            self._pending.release()
+
+    def _forget(self, chat_id, task: asyncio.Task):
+        if self._last.get(chat_id) is task:
+            del self._last[chat_id]
+
+    async def join(self):
+        while self._last:
+            await asyncio.wait(list(self._last.values()))
+
+
+def run_shard_worker(
+    app_class: "Type[AppBase]",
+    config: "AppConfig",
+    shard: int,
+    updates: multiprocessing.Queue,
+    heartbeat,
+):
+    """
+    Worker process entry point: create the app and handle updates of the shard
+    """
+    # ctrl+c reaches the whole process group - the supervisor stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = app_class(config=config)
+    asyncio.run(_run_shard_worker(app, shard, updates, heartbeat))
+
+
+async def _beat(heartbeat):
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+_NO_UPDATE = object()
+
+
+def _get_update(updates: multiprocessing.Queue):
+    # with a timeout, so that the worker notices SIGTERM while the queue is empty
+    try:
+        return updates.get(timeout=QUEUE_POLL_INTERVAL)
+    except queue.Empty:
+        return _NO_UPDATE
+
+
+async def _run_shard_worker(app: "AppBase", shard: int, updates, heartbeat):
+    logger = app.logger.bind(shard=shard)
+    bot = app.bot
+    await bot.bootstrap()
+    beat = asyncio.create_task(_beat(heartbeat))
+    runner = ChatOrderedRunner(logger=logger)
+    # SIGTERM to the worker - finish the updates taken, leave the rest queued
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    logger.info(f"Shard {shard} started")
+    try:
+        while not stopping.is_set():
+            data = await asyncio.to_thread(_get_update, updates)
+            if data is _NO_UPDATE:
+                continue
+            if data is None:
+                break
+            update = types.Update.model_validate(
+                data, context={"bot": bot._aiogram_bot}
+            )
+            await runner.submit(
+                get_update_chat_id(data),
+                bot._dp.feed_update,
+                bot._aiogram_bot,
+                update,
+            )
+        await runner.join()
+    finally:
+        beat.cancel()
+        await bot._stop_pyrogram_client()
+        await bot._aiogram_bot.session.close()
+    logger.info(f"Shard {shard} stopped")
+
+
+class ShardSupervisor:
+    """
+    Poll updates once and distribute them across worker processes
+    Dead or stuck workers are restarted, their queued updates are kept
+    """
+
+    def __init__(self, app: "AppBase", num_workers: int = None, logger=None):
+        self.app = app
+        self.num_workers = num_workers or os.cpu_count() or 1
+        if logger is None:
+            logger = app.logger
+        self.logger = logger
+        # spawn - forking a process with a live event loop and mongo client is unsafe
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(QUEUE_SIZE) for _ in range(self.num_workers)]
+        self.heartbeats = [
+            self._context.Value("d", 0.0) for _ in range(self.num_workers)
+        ]
+        self.workers: List[Optional[SpawnProcess]] = [None] * self.num_workers
+
+    def _start_worker(self, shard: int):
+        self.heartbeats[shard].value = time.time()  # grace period for startup
+        worker = self._context.Process(
+            target=run_shard_worker,
+            args=(
+                type(self.app),
+                self.app.config,
+                shard,
+                self.queues[shard],
+                self.heartbeats[shard],
+            ),
+            name=f"shard-{shard}",
+            daemon=True,
+        )
+        worker.start()
+        self.workers[shard] = worker
+        self.logger.info(f"Started shard {shard}, pid {worker.pid}")
+
+    def check_workers(self):
+        for shard, worker in enumerate(self.workers):
+            silence = time.time() - self.heartbeats[shard].value
+            if worker.is_alive() and silence < HEARTBEAT_TIMEOUT:
+                continue
+            if worker.is_alive():
+                self.logger.warning(f"Shard {shard} is stuck for {silence:.0f}s")
+                worker.kill()
+                worker.join()
+            else:
+                self.logger.warning(f"Shard {shard} exited with code {worker.exitcode}")
+            self._start_worker(shard)
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            self.check_workers()
+
+    async def _poll(self):
+        bot = self.app.bot._aiogram_bot
+        allowed_updates = self.app.bot._dp.resolve_used_update_types()
+        offset = None
+        failures = 0
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=POLL_TIMEOUT,
+                    allowed_updates=allowed_updates,
+                )
+            except Exception as e:
+                # network errors and telegram 5xx - keep polling, as aiogram does
+                delay = min(POLL_RETRY_DELAY * 2**failures, POLL_RETRY_MAX_DELAY)
+                failures += 1
+                self.logger.warning(
+                    f"Failed to get updates, retrying in {delay}s: {e!r}"
+                )
+                await asyncio.sleep(delay)
+                continue
+            failures = 0
+            for update in updates:
+                data = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+                shard = shard_for_update(data, self.num_workers)
+                # blocks while the worker's queue is full
+                await asyncio.to_thread(self.queues[shard].put, data)
+                offset = update.update_id + 1
+
+    async def run(self):
+        # handlers are registered to know the used update types and commands
+        await self.app.bot.bootstrap()
+        await self.app.bot._set_aiogram_bot_commands()
+        for shard in range(self.num_workers):
+            self._start_worker(shard)
+        monitor = asyncio.create_task(self._monitor())
+        poll = asyncio.create_task(self._poll())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, poll.cancel)
+        try:
+            await poll
+        except asyncio.CancelledError:
+            self.logger.info("Stopping: draining the workers")
+        finally:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(sig)
+            monitor.cancel()
+            await self.stop()
+
+    async def _send_stop(self, shard: int, deadline: float):
+        worker = self.workers[shard]
+        if worker is None or not worker.is_alive():
+            return  # nobody would take the marker off a full queue
+        try:
+            await asyncio.to_thread(
+                self.queues[shard].put, None, True, max(deadline - time.time(), 0)
+            )
+        except queue.Full:
+            self.logger.warning(f"Shard {shard} doesn't take updates, killing it")
+            worker.kill()
+
+    async def stop(self):
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        await asyncio.gather(
+            *(self._send_stop(shard, deadline) for shard in range(self.num_workers))
+        )
+        for worker in self.workers:
+            if worker is None:
+                continue
+            await asyncio.to_thread(worker.join, max(deadline - time.time(), 0))
+            if worker.is_alive():
+                worker.kill()
+        await self.app.bot._aiogram_bot.session.close()
@@ -9,6 +9,7 @@ import pprint
 import pyrogram
 import random
 import re
+import signal
 import subprocess
 import textwrap
 import traceback
@@ -16,7 +17,9 @@ from abc import ABC, abstractmethod
 from aiogram import F
 from aiogram import types
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
+from aiohttp import web
 from datetime import datetime
 from dotenv import load_dotenv
 from functools import wraps
@@ -25,16 +28,27 @@ from pathlib import Path
 from pydantic import BaseModel
 from tempfile import mkstemp
 from textwrap import dedent
-from typing import TYPE_CHECKING, Union, Optional
+from typing import TYPE_CHECKING, AsyncIterator, Union, Optional
 from typing import Type, List, Dict
 
 from bot_base.core import TelegramBotConfig
 from bot_base.utils import tools_dir
+from bot_base.utils.async_utils import SingleFlight
+from bot_base.utils.download_utils import (
+    PYROGRAM_CHUNK_SIZE,
+    ParallelDownloader,
+    get_message_media,
+)
+from bot_base.utils.outbound_utils import OutboundQueue, Priority, TextInputFile
 from bot_base.utils.text_utils import (
     MAX_TELEGRAM_MESSAGE_LENGTH,
-    split_long_message,
+    iter_split_long_message,
     escape_md,
+    prepare_markdown_v2,
+    reject_markdown_v2,
+    stitch_transcripts,
 )
+from bot_base.utils.webhook_utils import WebhookServer
 
 if TYPE_CHECKING:
     from bot_base.core import App
@@ -84,6 +98,13 @@ class TelegramBotBase(ABC):
 
         # Pyrogram
         self.pyrogram_client = self._init_pyrogram_client()
+        self._pyrogram_client_lock = asyncio.Lock()
+        self._pyrogram_download_semaphore = asyncio.Semaphore(
+            config.max_concurrent_downloads
+        )
+        self._parallel_downloader: Optional[ParallelDownloader] = None
+        # file_unique_id -> in-memory download in progress
+        self._in_memory_downloads = SingleFlight()
 
         if config.parse_mode is not None:
             # Warn about broken features if parse_mode is not None
@@ -96,6 +117,13 @@ class TelegramBotBase(ABC):
             token=token  # , parse_mode=self.config.parse_mode  # plain text
         )
         self._dp: aiogram.Dispatcher = aiogram.Dispatcher(bot=self._aiogram_bot)
+        # all sends go through the queue to stay within telegram's flood limits
+        self.outbound = OutboundQueue(
+            global_rate=config.outbound_global_rate,
+            chat_rate=config.outbound_chat_rate,
+            group_rate=config.outbound_group_rate,
+            logger=self.logger,
+        )
         self._me = None
 
     @property
@@ -108,8 +136,35 @@ class TelegramBotBase(ABC):
             api_id=self.config.api_id.get_secret_value(),
             api_hash=self.config.api_hash.get_secret_value(),
             bot_token=self.config.token.get_secret_value(),
+            # updates are received with aiogram, pyrogram is only used for files
+            no_updates=True,
+            # actual limits are enforced by the download semaphores
+            max_concurrent_transmissions=self.config.max_concurrent_downloads
+            * self.config.parallel_download_parts,
         )
 
+    async def _get_pyrogram_client(self) -> pyrogram.Client:
+        """
+        Start the pyrogram client once and keep the session for the bot lifetime
+        """
+        async with self._pyrogram_client_lock:
+            if not self.pyrogram_client.is_connected:
+                # pyrogram binds to the event loop at construction time
+                # and the client is created before asyncio.run() - recreate it
+                if self.pyrogram_client.loop is not asyncio.get_running_loop():
+                    self.pyrogram_client = self._init_pyrogram_client()
+                self.logger.info("Starting pyrogram client")
+                await self.pyrogram_client.start()
+        return self.pyrogram_client
+
+    async def _stop_pyrogram_client(self):
+        async with self._pyrogram_client_lock:
+            if self._parallel_downloader is not None:
+                await self._parallel_downloader.close()
+            if self.pyrogram_client.is_connected:
+                self.logger.info("Stopping pyrogram client")
+                await self.pyrogram_client.stop()
+
     def _load_config(self, **kwargs):
         load_dotenv()
         return self._config_class(**kwargs)
@@ -164,13 +219,60 @@ class TelegramBotBase(ABC):
         bot_link = f"https://t.me/{bot_name}"
         self.logger.info(f"Starting telegram bot at {bot_link}")
         # And the run events dispatching
-        await self._dp.start_polling(self._aiogram_bot)
+        try:
+            if self.config.run_mode == "webhook":
+                await self._run_webhook()
+            else:
+                await self._dp.start_polling(self._aiogram_bot)
+        finally:
+            await self._stop_pyrogram_client()
+
+    def _init_webhook_server(self) -> WebhookServer:
+        return WebhookServer(
+            self._dp,
+            self._aiogram_bot,
+            path=self.config.webhook_path,
+            secret_token=self.config.webhook_secret.get_secret_value() or None,
+            max_concurrent_updates=self.config.webhook_max_concurrent_updates,
+            drain_timeout=self.config.webhook_drain_timeout,
+            logger=self.logger,
+        )
 
-    # todo: app.run(...)
-    # async def download_large_file(self, chat_id, message_id):
-    #     async with self.pyrogram_client as app:
-    #         message = await app.get_messages(chat_id, message_ids=message_id)
-    #         return await message.download(in_memory=True)
+    async def _run_webhook(self):
+        server = self._init_webhook_server()
+        runner = web.AppRunner(server.make_app())
+        await runner.setup()
+        site = web.TCPSite(
+            runner, host=self.config.webhook_host, port=self.config.webhook_port
+        )
+        await site.start()
+        await self._dp.emit_startup(bot=self._aiogram_bot, dispatcher=self._dp)
+        try:
+            # every replica sets the same url - no need to delete it on exit
+            await self._aiogram_bot.set_webhook(
+                self.config.webhook_url.rstrip("/") + self.config.webhook_path,
+                secret_token=server.secret_token,
+                allowed_updates=self._dp.resolve_used_update_types(),
+            )
+            self.logger.info(
+                f"Serving webhook on {self.config.webhook_host}:"
+                f"{self.config.webhook_port}{self.config.webhook_path}"
+            )
+            # serve until SIGTERM (e.g. container stop) or ctrl+c
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            try:
+                await stop.wait()
+            finally:
+                for sig in (signal.SIGTERM, signal.SIGINT):
+                    loop.remove_signal_handler(sig)
+            self.logger.info("Stopping webhook, draining the running updates")
+        finally:
+            await runner.cleanup()  # drains the running updates
+            await self._dp.emit_shutdown(bot=self._aiogram_bot, dispatcher=self._dp)
+            await self._aiogram_bot.session.close()
 
     def _check_pyrogram_tokens(self):
         if not (
@@ -185,7 +287,75 @@ class TelegramBotBase(ABC):
     async def download_large_file(self, chat_id, message_id, target_path=None):
         # todo: troubleshoot chat_id. Only username works for now.
         self._check_pyrogram_tokens()
+        if self.config.download_large_files_in_process:
+            return await self._download_large_file_in_process(
+                chat_id, message_id, target_path=target_path
+            )
+        return await self._download_large_file_with_subprocess(
+            chat_id, message_id, target_path=target_path
+        )
+
+    async def _download_large_file_in_process(
+        self, chat_id, message_id, target_path=None
+    ):
+        """
+        Download the file with the shared pyrogram session
+        If target_path is not provided - download into memory
+        """
+        client = await self._get_pyrogram_client()
+        async with self._pyrogram_download_semaphore:
+            message = await client.get_messages(chat_id, message_ids=message_id)
+            self.logger.debug(f"Downloading large file from message {message_id}")
+            if self.config.parallel_download_parts > 1:
+                return await self._download_in_parts(
+                    client, message, target_path=target_path
+                )
+            if target_path is None:
+                return await client.download_media(message, in_memory=True)
+            return await client.download_media(message, file_name=str(target_path))
 
+    def _get_parallel_downloader(self, client) -> ParallelDownloader:
+        if self._parallel_downloader is None or (
+            self._parallel_downloader.client is not client
+        ):
+            self._parallel_downloader = ParallelDownloader(
+                client,
+                concurrency=self.config.parallel_download_parts,
+                per_dc_limit=self.config.parallel_download_per_dc_limit,
+                part_size=self.config.parallel_download_part_size_mb
+                * PYROGRAM_CHUNK_SIZE,
+                logger=self.logger,
+            )
+        return self._parallel_downloader
+
+    async def _download_to_bytes(self, client, message) -> bytes:
+        media = get_message_media(message)
+        # stable path, so that an interrupted download can be resumed
+        file_path = self.downloads_dir / media.file_unique_id
+        downloader = self._get_parallel_downloader(client)
+        await downloader.download(message, file_path)
+        data = file_path.read_bytes()
+        os.unlink(file_path)
+        return data
+
+    async def _download_in_parts(self, client, message, target_path=None):
+        media = get_message_media(message)
+        if target_path is not None:
+            downloader = self._get_parallel_downloader(client)
+            await downloader.download(message, target_path)
+            return target_path
+        # the same media downloaded concurrently (e.g. forwarded twice) would
+        # share the file and its parts state - share the download instead
+        data = await self._in_memory_downloads.run(
+            media.file_unique_id, self._download_to_bytes, client, message
+        )
+        file_data = BytesIO(data)
+        file_data.name = getattr(media, "file_name", None) or media.file_unique_id
+        return file_data
+
+    async def _download_large_file_with_subprocess(
+        self, chat_id, message_id, target_path=None
+    ):
         script_path = tools_dir / "download_file_with_pyrogram.py"
 
         # Construct command to run the download script
@@ -516,7 +686,13 @@ class TelegramBot(TelegramBotBase):
         if message.voice or message.audio:
             # todo: accept voice message? Seems to work
             chunks = await self._process_voice_message(message)
-            result += "\n\n".join(chunks)
+            # chunks overlap, also the silence-aware ones where no pause was
+            # found at a cut - remove the duplicated words at the seams
+            if self.app.config.split_audio_on_silence:
+                # the other seams are cut in pauses, continue the text
+                result += stitch_transcripts(chunks, sep=" ")
+            else:
+                result += stitch_transcripts(chunks)
         # todo: accept files?
         if message.document and message.document.mime_type == "text/plain":
             self.logger.info(f"Received text file: {message.document.file_name}")
@@ -543,8 +719,19 @@ class TelegramBot(TelegramBotBase):
         else:
             raise ValueError("No audio file detected")
 
+        # the same voice notes are forwarded and replied to a lot
+        cache_key = f"file:{file_desc.file_unique_id}"
+        chunks = await self.app.transcription_cache.aget(cache_key)
+        if chunks is not None:
+            self.logger.debug(f"Using cached transcription for {cache_key}")
+            return chunks
+
         file = await self.download_file(message, file_desc)
-        return await self.app.parse_audio(file, parallel=parallel)
+        chunks = await self.app.parse_audio(
+            file, parallel=parallel, chat_id=message.chat.id
+        )
+        await self.app.transcription_cache.aset(cache_key, chunks)
+        return chunks
 
     async def download_file(self, message: types.Message, file_desc, file_path=None):
         if file_desc.file_size < 20 * 1024 * 1024:
@@ -586,7 +773,7 @@ class TelegramBot(TelegramBotBase):
         self.logger.info(
             "Multi-message mode deactivated. Processing messages",
             user=message.from_user.username,
-            data=str(self.messages_stack),
+            data=lambda: str(self.messages_stack),
         )
         response = await self.process_messages_stack(chat_id)
         await message.answer(response)
@@ -629,100 +816,229 @@ class TelegramBot(TelegramBotBase):
         escape_markdown=False,
         wrap=True,
         parse_mode=None,
+        priority: Priority = Priority.INTERACTIVE,
     ):
-        if wrap:
+        as_file = (
+            self.send_long_messages_as_files and len(text) > MAX_TELEGRAM_MESSAGE_LENGTH
+        )
+        # files are sent as is - no need to wrap multi-MB texts
+        if wrap and not as_file:
             lines = text.split("\n")
             new_lines = [textwrap.fill(line, width=88) for line in lines]
             text = "\n".join(new_lines)
-        # todo: add 3 send modes - always text, always file, auto
-        if self.send_long_messages_as_files:
-            if len(text) > MAX_TELEGRAM_MESSAGE_LENGTH:
-                if filename is None:
-                    filename = f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt"
-                if self.config.send_preview_for_long_messages:
-                    preview = text[: self.PREVIEW_CUTOFF]
-                    if escape_markdown:
-                        preview = escape_md(preview)
-                    await self._aiogram_bot.send_message(
-                        chat_id,
-                        dedent(
-                            f"""
-                            Message is too long, sending as file {escape_md(filename)} 
-                            Preview: 
-                            """
+        # keep the parts of the reply together
+        async with self.outbound.ordered(chat_id):
+            # todo: add 3 send modes - always text, always file, auto
+            if self.send_long_messages_as_files:
+                if as_file:
+                    if filename is None:
+                        filename = f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt"
+                    if self.config.send_preview_for_long_messages:
+                        preview = text[: self.PREVIEW_CUTOFF]
+                        if escape_markdown:
+                            preview = escape_md(preview)
+                        await self.outbound.send(
+                            chat_id,
+                            self._aiogram_bot.send_message,
+                            chat_id,
+                            dedent(
+                                f"""
+                                Message is too long, sending as file {escape_md(filename)} 
+                                Preview: 
+                                """
+                            )
+                            + preview
+                            + "...",
+                            priority=priority,
                         )
-                        + preview
-                        + "...",
-                    )
 
-                await self._send_as_file(
-                    chat_id,
-                    text,
-                    reply_to_message_id=reply_to_message_id,
-                    filename=filename,
-                )
-            else:  # len(text) < MAX_TELEGRAM_MESSAGE_LENGTH:
-                message_text = text
-                if escape_markdown:
-                    message_text = escape_md(text)
-                if filename:
-                    message_text = escape_md(filename) + "\n" + message_text
-                await self._send_with_parse_mode_fallback(
-                    text=message_text,
-                    chat_id=chat_id,
-                    reply_to_message_id=reply_to_message_id,
-                    parse_mode=parse_mode,
-                )
-        else:  # not self.send_long_messages_as_files
-            for chunk in split_long_message(text):
+                    await self._send_as_file(
+                        chat_id,
+                        text,
+                        reply_to_message_id=reply_to_message_id,
+                        filename=filename,
+                        priority=priority,
+                    )
+                else:  # len(text) < MAX_TELEGRAM_MESSAGE_LENGTH:
+                    message_text = text
+                    if escape_markdown:
+                        message_text = escape_md(text)
+                    if filename:
+                        message_text = escape_md(filename) + "\n" + message_text
+                    # escaping can push the text over the limit
+                    for chunk in iter_split_long_message(message_text):
+                        await self._send_with_parse_mode_fallback(
+                            text=chunk,
+                            chat_id=chat_id,
+                            reply_to_message_id=reply_to_message_id,
+                            parse_mode=parse_mode,
+                            priority=priority,
+                        )
+            else:  # not self.send_long_messages_as_files
+                # escape first - the splitter keeps escape sequences whole
+                # and the escaped chunks stay within the limit
                 if escape_markdown:
-                    chunk = escape_md(chunk)
-                await self._send_with_parse_mode_fallback(
-                    chat_id,
-                    chunk,
-                    reply_to_message_id=reply_to_message_id,
-                    parse_mode=parse_mode,
-                )
+                    text = escape_md(text)
+                for chunk in iter_split_long_message(text):
+                    await self._send_with_parse_mode_fallback(
+                        chat_id,
+                        chunk,
+                        reply_to_message_id=reply_to_message_id,
+                        parse_mode=parse_mode,
+                        priority=priority,
+                    )
 
     async def _send_with_parse_mode_fallback(
-        self, chat_id, text, reply_to_message_id=None, parse_mode=None
+        self,
+        chat_id,
+        text,
+        reply_to_message_id=None,
+        parse_mode=None,
+        priority: Priority = Priority.INTERACTIVE,
     ):
         """
         Send message with parse_mode=None if parse_mode is not supported
         """
         if parse_mode is None:
             parse_mode = self.config.parse_mode
+        message_text = text
+        if parse_mode == ParseMode.MARKDOWN_V2:
+            # check locally instead of a failed request and a second one
+            message_text = prepare_markdown_v2(text)
+            if message_text is None:
+                message_text, parse_mode = text, None
         try:
-            await self._aiogram_bot.send_message(
+            await self.outbound.send(
                 chat_id,
-                text,
+                self._aiogram_bot.send_message,
+                chat_id,
+                message_text,
                 reply_to_message_id=reply_to_message_id,
                 parse_mode=parse_mode,
+                priority=priority,
             )
-        except Exception:
+            return
+        except TelegramRetryAfter:
+            # flood control, not a parse error - the queue already retried
+            raise
+        except Exception as e:
+            if parse_mode is None:
+                raise
+            if parse_mode == ParseMode.MARKDOWN_V2:
+                reject_markdown_v2(text)
             self.logger.warning(
                 f"Failed to send message with parse_mode={parse_mode}. "
-                f"Retrying with parse_mode=None"
-                f"Exception: {traceback.format_exc()}"
-                # todo , data=traceback.format_exc()
+                f"Retrying with parse_mode=None. Exception: {e}"
             )
-            await self._aiogram_bot.send_message(
+            await self.outbound.send(
+                chat_id,
+                self._aiogram_bot.send_message,
                 chat_id,
                 text,
                 reply_to_message_id=reply_to_message_id,
                 parse_mode=None,
+                priority=priority,
             )
 
     async def _send_as_file(
-        self, chat_id, text, reply_to_message_id=None, filename=None
+        self,
+        chat_id,
+        text,
+        reply_to_message_id=None,
+        filename=None,
+        priority: Priority = Priority.INTERACTIVE,
     ):
-        from aiogram.types.input_file import BufferedInputFile
-
-        temp_file = BufferedInputFile(text.encode("utf-8"), filename)
-        await self._aiogram_bot.send_document(
-            chat_id, temp_file, reply_to_message_id=reply_to_message_id
+        temp_file = TextInputFile(text, filename)
+        await self.outbound.send(
+            chat_id,
+            self._aiogram_bot.send_document,
+            chat_id,
+            temp_file,
+            reply_to_message_id=reply_to_message_id,
+            priority=priority,
         )
 
+    PROGRESS_SUFFIX = "\n..."
+
+    async def send_progressively(
+        self,
+        chat_id,
+        updates: AsyncIterator[str],
+        reply_to_message_id=None,
+        min_interval: float = None,
+    ) -> Optional[str]:
+        """
+        Show a growing text in one message, edited in place
+        updates - text snapshots, e.g. from aiter_map_gpt_command
+        Edits are throttled to one per min_interval, intermediate snapshots are
+        skipped. Partial text is sent as plain text; if the final text doesn't
+        fit into a message, it's sent with send_safe
+        Returns the final text
+        """
+        if min_interval is None:
+            min_interval = self.config.progressive_edit_interval
+        limit = MAX_TELEGRAM_MESSAGE_LENGTH - len(self.PROGRESS_SUFFIX)
+        latest = None
+        changed = asyncio.Event()
+
+        async def consume():
+            nonlocal latest
+            async for text in updates:
+                latest = text
+                changed.set()
+
+        message = None
+        shown = None
+
+        async def render(final=False):
+            nonlocal message, shown
+            text = latest[:limit]
+            if final and len(latest) <= limit:
+                preview = text
+            else:
+                preview = text + self.PROGRESS_SUFFIX
+            if not text.strip() or preview == shown:
+                return
+            if message is None:
+                message = await self.outbound.send(
+                    chat_id,
+                    self._aiogram_bot.send_message,
+                    chat_id,
+                    preview,
+                    reply_to_message_id=reply_to_message_id,
+                )
+            else:
+                await self.outbound.send(
+                    chat_id,
+                    self._aiogram_bot.edit_message_text,
+                    preview,
+                    chat_id=chat_id,
+                    message_id=message.message_id,
+                )
+            shown = preview
+
+        consumer = asyncio.create_task(consume())
+        try:
+            while not consumer.done():
+                waiter = asyncio.create_task(changed.wait())
+                await asyncio.wait(
+                    [consumer, waiter], return_when=asyncio.FIRST_COMPLETED
+                )
+                waiter.cancel()
+                if changed.is_set() and not consumer.done():
+                    changed.clear()
+                    await render()
+                    await asyncio.sleep(min_interval)
+            await consumer  # re-raise errors of the producer
+        finally:
+            consumer.cancel()
+        if latest is not None:
+            await render(final=True)
+
+        if latest is not None and len(latest) > limit:
+            await self.send_safe(latest, chat_id, reply_to_message_id)
+        return latest
+
     @property
     def send_long_messages_as_files(self):
         return self.config.send_long_messages_as_files
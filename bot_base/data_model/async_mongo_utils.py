@@ -0,0 +1,154 @@
+"""
+Async versions of the mongo_utils CRUD helpers, for use in bot handlers
+
+connect_to_db()  # motor client with a connection pool
+await add_item(SQDQueueItem, name='item1', url='url1')
+await get_item(SQDQueueItem, 'item1')  # By name or _id
+await update_item(SQDQueueItem, 'item1', url='new_url1')
+await delete_item(SQDQueueItem, 'item1')
+await list_items(SQDQueueItem, url='new_url1')
+
+The documents are the same mongoengine classes. Queries go through motor if
+connect_to_db was called (pip install motor), otherwise the blocking
+mongoengine connection is used from a worker thread - e.g. with mongomock
+"""
+import asyncio
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Type
+
+import mongoengine
+from dotenv import load_dotenv
+from mongoengine.queryset import transform
+
+from bot_base.data_model.mongo_utils import get_key_filter
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+MAX_POOL_SIZE = 100
+
+_clients: Dict[str, "AsyncIOMotorClient"] = {}  # alias -> client
+_db_names: Dict[str, str] = {}
+
+
+def connect_to_db(
+    conn_str=None, db_name=None, alias="default", max_pool_size=MAX_POOL_SIZE
+):
+    """
+    Create the motor client for the alias, the connection is opened on first use
+    """
+    if AsyncIOMotorClient is None:
+        raise ImportError("motor is required for async mongo: pip install motor")
+    if alias in _clients:
+        return _clients[alias]
+    dotenv_path = Path(os.curdir) / ".env"
+    load_dotenv(dotenv_path)
+
+    if conn_str is None:
+        conn_str = os.getenv("DATABASE_CONN_STR")
+        if conn_str is None:
+            raise ValueError("Connection string not provided")
+
+    if db_name is None:
+        db_name = os.getenv("DATABASE_NAME")
+        if db_name is None:
+            raise ValueError("Database name not provided")
+
+    _clients[alias] = AsyncIOMotorClient(conn_str, maxPoolSize=max_pool_size)
+    _db_names[alias] = db_name
+    return _clients[alias]
+
+
+def disconnect(alias="default"):
+    client = _clients.pop(alias, None)
+    _db_names.pop(alias, None)
+    if client is not None:
+        client.close()
+
+
+class _ThreadCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    async def to_list(self, length: Optional[int] = None):
+        if length is not None:
+            self._cursor = self._cursor.limit(length)
+        return await asyncio.to_thread(list, self._cursor)
+
+
+class _ThreadCollection:
+    """
+    The subset of the motor collection api used here, over a pymongo collection
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    async def insert_one(self, document):
+        return await asyncio.to_thread(self._collection.insert_one, document)
+
+    async def find_one(self, filter):
+        return await asyncio.to_thread(self._collection.find_one, filter)
+
+    async def update_one(self, filter, update):
+        return await asyncio.to_thread(self._collection.update_one, filter, update)
+
+    async def delete_one(self, filter):
+        return await asyncio.to_thread(self._collection.delete_one, filter)
+
+    def find(self, filter):
+        return _ThreadCursor(self._collection.find(filter))
+
+
+def get_collection(cls: Type[mongoengine.Document]):
+    alias = cls._meta.get("db_alias", "default")
+    if alias not in _clients:
+        return _ThreadCollection(cls._get_collection())
+    return _clients[alias][_db_names[alias]][cls._get_collection_name()]
+
+
+def _get_query(cls, **filters) -> dict:
+    query = transform.query(cls, **filters)
+    if cls._meta.get("allow_inheritance"):
+        query["_cls"] = {"$in": cls._subclasses}
+    return query
+
+
+async def add_item(cls, **kwargs):
+    item = cls(**kwargs)
+    item.validate()
+    result = await get_collection(cls).insert_one(item.to_mongo())
+    item.pk = result.inserted_id
+    return item
+
+
+async def get_item(cls, key):
+    query = _get_query(cls, **get_key_filter(cls, key))
+    data = await get_collection(cls).find_one(query)
+    if data is None:
+        return None
+    return cls._from_son(data)
+
+
+async def update_item(cls, key, **kwargs):
+    """
+    Update in place, kwargs as in mongoengine: url="...", inc__count=1
+    """
+    query = _get_query(cls, **get_key_filter(cls, key))
+    update = transform.update(cls, **kwargs)
+    result = await get_collection(cls).update_one(query, update)
+    return result.matched_count
+
+
+async def delete_item(cls, key):
+    query = _get_query(cls, **get_key_filter(cls, key))
+    result = await get_collection(cls).delete_one(query)
+    return result.deleted_count
+
+
+async def list_items(cls, limit: Optional[int] = None, **filters) -> List:
+    cursor = get_collection(cls).find(_get_query(cls, **filters))
+    return [cls._from_son(data) for data in await cursor.to_list(length=limit)]
@@ -27,15 +27,28 @@ Items can be deleted by providing their _id or name.
 delete_item(SQDQueueItem, '5ff751482749093351c3e90f')
 delete_item(SQDQueueItem, 'item1')
 
+# Bulk operations
+One round trip for many items
+
+add_items(SQDQueueItem, [{'name': 'item1', 'url': 'url1'}, ...])
+update_items(SQDQueueItem, {'item1': {'url': 'new_url1'}, ...})
+upsert_items(SQDQueueItem, [{'name': 'item1', 'url': 'url1'}, ...])  # by name
+
 """
 import os
 from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
 
 import mongoengine
 from bson import ObjectId
 from dotenv import load_dotenv
+from mongoengine.base.common import _document_registry
+from mongoengine.queryset import transform
+from pymongo import InsertOne, UpdateOne
+from pymongo.results import BulkWriteResult
 
 default_database_connected = False
+_name_indexed = set()
 
 
 def connect_to_db(conn_str=None, db_name=None, alias=None, **kwargs):
@@ -61,6 +74,41 @@ def connect_to_db(conn_str=None, db_name=None, alias=None, **kwargs):
     return mongoengine.connect(db=db_name, host=conn_str, alias=alias, **kwargs)
 
 
+def ensure_name_index(cls):
+    """
+    Index the name field once per class, for get_item / update_item by name
+    """
+    if cls in _name_indexed or "name" not in cls._fields:
+        return
+    cls._get_collection().create_index(cls._fields["name"].db_field)
+    _name_indexed.add(cls)
+
+
+def ensure_name_indexes():
+    """
+    Index the name field of all registered document classes
+    """
+    for cls in _document_registry.values():
+        if not cls._meta.get("abstract") and issubclass(cls, mongoengine.Document):
+            ensure_name_index(cls)
+
+
+def get_key_filter(cls, key) -> dict:
+    """
+    Filter by _id if the key looks like an ObjectId, otherwise by name
+    """
+    if isinstance(key, ObjectId) or ObjectId.is_valid(key):
+        return {"id": ObjectId(key)}
+    return {"name": key}
+
+
+def _get_queryset(cls, key):
+    key_filter = get_key_filter(cls, key)
+    if "name" in key_filter:
+        ensure_name_index(cls)
+    return cls.objects(**key_filter)
+
+
 def add_item(cls, **kwargs):
     item = cls(**kwargs)
     item.save()
@@ -68,30 +116,96 @@ def add_item(cls, **kwargs):
 
 
 def get_item(cls, key):
-    try:
-        # Try finding by ObjectId first
-        return cls.objects(id=ObjectId(key)).first()
-    except:
-        # Fallback to find by name
-        return cls.objects(name=key).first()
+    return _get_queryset(cls, key).first()
 
 
 def update_item(cls, key, **kwargs):
-    item = get_item(cls, key)
-    if item:
-        item.update(**kwargs)
+    """
+    Update in a single query, returns the number of updated items (0 or 1)
+    """
+    return _get_queryset(cls, key).update_one(**kwargs)
 
 
 def delete_item(cls, key):
-    item = get_item(cls, key)
-    if item:
+    queryset = _get_queryset(cls, key)
+    if cls._meta.get("delete_rules"):
+        # cascade / deny rules need the document
+        item = queryset.first()
+        if item is None:
+            return 0
         item.delete()
+        return 1
+    return cls._get_collection().delete_one(queryset._query).deleted_count
 
 
 def list_items(cls, **filters):
     return cls.objects(**filters).all()
 
 
+def add_items(cls, items: Iterable[dict]) -> List:
+    """
+    Insert many items in one round trip
+    """
+    documents = [cls(**kwargs) for kwargs in items]
+    for document in documents:
+        document.validate()
+    if not documents:
+        return documents
+    sons = [document.to_mongo() for document in documents]
+    cls._get_collection().bulk_write([InsertOne(son) for son in sons], ordered=False)
+    for document, son in zip(documents, sons):
+        document.pk = son["_id"]  # set by pymongo on insert
+    return documents
+
+
+def update_items(cls, updates: Dict[Any, dict]) -> Optional[BulkWriteResult]:
+    """
+    Update many items in one round trip, None if there is nothing to update
+    update_items(SQDQueueItem, {'item1': {'url': 'url1'}, 'item2': {'inc__count': 1}})
+    """
+    if not updates:
+        return None
+    requests = [
+        UpdateOne(
+            _get_queryset(cls, key)._query,
+            transform.update(cls, **kwargs),
+        )
+        for key, kwargs in updates.items()
+    ]
+    return cls._get_collection().bulk_write(requests, ordered=False)
+
+
+def upsert_items(
+    cls, items: Iterable[dict], key: str = "name"
+) -> Optional[BulkWriteResult]:
+    """
+    Insert or update many items, matched by the key field, in one round trip
+    None if there is nothing to upsert
+    Existing items get only the given fields updated
+    """
+    requests = []
+    for kwargs in items:
+        document = cls(**kwargs)
+        document.validate()
+        update = transform.update(cls, **kwargs)
+        # defaults only for new items, existing ones keep their other fields
+        update["$setOnInsert"] = {
+            field: value
+            for field, value in document.to_mongo().items()
+            if field != "_id" and field not in update["$set"]
+        }
+        if not update["$setOnInsert"]:
+            del update["$setOnInsert"]
+        requests.append(
+            UpdateOne(cls.objects(**{key: kwargs[key]})._query, update, upsert=True)
+        )
+    if key == "name":
+        ensure_name_index(cls)
+    if not requests:
+        return None
+    return cls._get_collection().bulk_write(requests, ordered=False)
+
+
 if __name__ == "__main__":
     connect_to_db()
 
@@ -0,0 +1,160 @@
+import asyncio
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+
+class _Job:
+    __slots__ = ("func", "args", "kwargs", "future", "task")
+
+    def __init__(self, func, args, kwargs, future: asyncio.Future):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.task: Optional[asyncio.Task] = None
+
+
+class FairScheduler:
+    """
+    Run coroutines with a global concurrency cap, fairly between keys (e.g. chats)
+
+    - at most `max_concurrency` jobs run at once, across all keys
+    - keys take turns: a key with 50 queued jobs gets one slot per round,
+      so it can't starve a key with a single job
+    - at most `max_queue_per_key` jobs wait per key, run() waits for space
+    - cancelling the caller of run() cancels its job, queued or running
+
+    scheduler = FairScheduler(max_concurrency=8)
+    text = await scheduler.run(chat_id, atranscribe_audio, chunk)
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue_per_key: int = 64):
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_key = max_queue_per_key
+        self._queues: Dict[Hashable, Deque[_Job]] = {}
+        self._turns: Deque[Hashable] = deque()  # keys with queued jobs
+        self._space_waiters: Dict[Hashable, Deque[asyncio.Future]] = defaultdict(deque)
+        self._running = 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def queued(self, key=None) -> int:
+        if key is not None:
+            return len(self._queues.get(key, ()))
+        return sum(map(len, self._queues.values()))
+
+    async def run(
+        self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        # backpressure: wait until the key's queue has space
+        while self.queued(key) >= self.max_queue_per_key:
+            waiter = loop.create_future()
+            self._space_waiters[key].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._space_waiters.get(key, ()):
+                    self._space_waiters[key].remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # we were woken up - pass the free slot on
+                    self._wake_space_waiter(key)
+                raise
+
+        job = _Job(func, args, kwargs, loop.create_future())
+        if key not in self._queues:
+            self._queues[key] = deque()
+            self._turns.append(key)
+        self._queues[key].append(job)
+        self._dispatch()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if job.task is not None:
+                job.task.cancel()
+            else:
+                self._remove_queued(key, job)
+            raise
+
+    def _remove_queued(self, key, job: _Job):
+        queue = self._queues.get(key)
+        if queue is None or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del self._queues[key]
+            self._turns.remove(key)
+        self._wake_space_waiter(key)
+
+    def _wake_space_waiter(self, key):
+        waiters = self._space_waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if not waiters:
+            self._space_waiters.pop(key, None)
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._turns:
+            key = self._turns.popleft()
+            queue = self._queues[key]
+            job = queue.popleft()
+            if queue:
+                self._turns.append(key)  # back of the line
+            else:
+                del self._queues[key]
+            self._wake_space_waiter(key)
+            if job.future.done():  # cancelled while queued
+                continue
+            self._running += 1
+            job.task = asyncio.create_task(self._run_job(job))
+
+    async def _run_job(self, job: _Job):
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except asyncio.CancelledError:
+            job.future.cancel()
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+
+class SingleFlight:
+    """
+    Share one in-flight call between concurrent callers with the same key
+
+    flights = SingleFlight()
+    result = await flights.run(key, fetch, url)  # concurrent callers await one fetch
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(
+        self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # a cancelled caller must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
@@ -1,42 +1,236 @@
 import asyncio
+import atexit
+import multiprocessing
+import os
 import pprint
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
-from typing import BinaryIO
+from itertools import islice
+from pathlib import Path
+from tempfile import mkstemp
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import loguru
+import numpy as np
 import tqdm
 from pydub import AudioSegment
+from pydub.utils import get_encoder_name, mediainfo_json
 
+from bot_base.utils.async_utils import FairScheduler
+from bot_base.utils.cache_utils import TieredCache, hash_bytes
 from bot_base.utils.gpt_utils import (
     Audio,
     atranscribe_audio,
-    transcribe_audio,
     WHISPER_RATE_LIMIT,
 )
 
 DEFAULT_PERIOD = 120 * 1000
 DEFAULT_BUFFER = 5 * 1000
+WHISPER_MAX_FILE_SIZE = 25 * 1024 * 1024  # bytes, the api upload limit
+CHUNK_BITRATE = 128_000  # bits per second of the exported mp3 chunks
+CHUNK_SIZE_MARGIN = 0.9  # for mp3 frame and container overhead
+
+
+def get_max_chunk_period(
+    max_size=WHISPER_MAX_FILE_SIZE, bitrate=CHUNK_BITRATE, margin=CHUNK_SIZE_MARGIN
+) -> int:
+    """
+    Longest chunk, in ms, that fits the upload limit once encoded
+    """
+    return int(max_size * 8 / bitrate * 1000 * margin)
+
+
+def plan_chunks(
+    duration: int, period=DEFAULT_PERIOD, buffer=DEFAULT_BUFFER
+) -> List[Tuple[int, int]]:
+    """
+    Calculate (start, end) boundaries of overlapping chunks, in ms
+    """
+    if duration / period > WHISPER_RATE_LIMIT - 5:
+        period = duration // (WHISPER_RATE_LIMIT - 5)
+
+    boundaries = []
+    s = 0
+    while s + period < duration:
+        boundaries.append((s, s + period))
+        s += period - buffer
+    boundaries.append((s, duration))
+    return boundaries
+
+
+# ------------------ Silence-aware boundaries ------------------ #
+
+ENERGY_WINDOW = 20  # ms
+ENERGY_SAMPLE_RATE = 8000  # plenty to find pauses in speech
+SILENCE_SEARCH = 20 * 1000  # look for a pause within 20s before the max cut
+SILENCE_THRESHOLD = 0.1  # relative to the level of loud speech
+
+_SAMPLE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def _window_rms(samples: np.ndarray, window: int) -> np.ndarray:
+    n = len(samples) // window * window
+    frames = samples[:n].reshape(-1, window).astype(np.float32)
+    return np.sqrt(np.mean(frames**2, axis=1))
+
+
+def audio_energy(audio: AudioSegment, window_ms=ENERGY_WINDOW) -> np.ndarray:
+    """
+    RMS energy of the audio per window_ms window
+    Computed block by block over a view of the raw data - PCM is not copied whole
+    """
+    window = audio.frame_rate * window_ms // 1000
+    samples = np.frombuffer(audio.raw_data, dtype=_SAMPLE_DTYPES[audio.sample_width])
+    samples = samples.reshape(-1, audio.channels)
+    block = window * 1000
+    energy = []
+    for i in range(0, len(samples), block):
+        mono = samples[i : i + block].mean(axis=1)
+        if audio.sample_width == 1:  # 8-bit audio is unsigned
+            mono -= 128
+        energy.append(_window_rms(mono, window))
+    return np.concatenate(energy) if energy else np.zeros(0, dtype=np.float32)
+
+
+def scan_energy_with_ffmpeg(path, window_ms=ENERGY_WINDOW) -> np.ndarray:
+    """
+    Same as audio_energy, but for a file: ffmpeg decodes it to low-rate mono PCM
+    which is read and reduced incrementally, so memory doesn't depend on duration
+    """
+    cmd = [
+        get_encoder_name(),
+        "-nostdin",
+        "-v",
+        "error",
+        "-i",
+        str(path),
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(ENERGY_SAMPLE_RATE),
+        "-f",
+        "s16le",
+        "pipe:1",
+    ]
+    window = ENERGY_SAMPLE_RATE * window_ms // 1000
+    window_bytes = window * 2
+    energy = []
+    rest = b""
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ) as process:
+        while data := process.stdout.read(window_bytes * 1000):
+            data = rest + data
+            n = len(data) // window_bytes * window_bytes
+            energy.append(_window_rms(np.frombuffer(data[:n], np.int16), window))
+            rest = data[n:]
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {path}")
+    return np.concatenate(energy) if energy else np.zeros(0, dtype=np.float32)
+
+
+def plan_chunks_on_silence(
+    energy: np.ndarray,
+    window_ms=ENERGY_WINDOW,
+    period: int = None,
+    buffer=DEFAULT_BUFFER,
+    duration: int = None,
+    search=SILENCE_SEARCH,
+    threshold=SILENCE_THRESHOLD,
+) -> List[Tuple[int, int]]:
+    """
+    Same as plan_chunks, but cut in pauses:
+    each chunk is as close to `period` as possible and ends at the quietest
+    moment of its last `search` ms. Chunks cut in silence don't overlap, the
+    `buffer` overlap is only used where no pause was found.
+    period - by default as long as the whisper upload limit allows
+    """
+    if period is None:
+        period = get_max_chunk_period()
+    if duration is None:
+        duration = len(energy) * window_ms
+    if len(energy) == 0:
+        return [(0, duration)]
+    if duration / period > WHISPER_RATE_LIMIT - 5:
+        period = duration // (WHISPER_RATE_LIMIT - 5)
+
+    silence_level = threshold * np.percentile(energy, 95)
+    period_windows = period // window_ms
+    search_windows = max(min(search, period // 2) // window_ms, 1)
+    buffer_windows = buffer // window_ms
+
+    boundaries = []
+    start = 0
+    while len(energy) - start > period_windows:
+        end = start + period_windows
+        candidates = energy[end - search_windows : end]
+        # take the latest of the quietest windows - keeps the chunk full
+        cut = end - 1 - int(np.argmin(candidates[::-1]))
+        if energy[cut] <= silence_level:
+            boundaries.append((start, cut))
+            start = cut
+        else:
+            boundaries.append((start, end))
+            start = end - buffer_windows
+    boundaries = [(s * window_ms, e * window_ms) for s, e in boundaries]
+    boundaries.append((start * window_ms, duration))
+    return boundaries
+
+
+def _plan_audio_chunks(
+    audio: AudioSegment, period, buffer, silence_aware=False
+) -> List[Tuple[int, int]]:
+    if not silence_aware:
+        return plan_chunks(len(audio), period or DEFAULT_PERIOD, buffer)
+    return plan_chunks_on_silence(
+        audio_energy(audio), period=period, buffer=buffer, duration=len(audio)
+    )
+
+
+def _plan_file_chunks(
+    path, period, buffer, silence_aware=False
+) -> List[Tuple[int, int]]:
+    if not silence_aware:
+        return plan_chunks(get_audio_duration(path), period or DEFAULT_PERIOD, buffer)
+    return plan_chunks_on_silence(
+        scan_energy_with_ffmpeg(path), period=period, buffer=buffer
+    )
+
+
+# --------------------------------------------- #
 
 
 def split_audio(
-    audio: Audio, period=DEFAULT_PERIOD, buffer=DEFAULT_BUFFER, logger=None
+    audio: Audio,
+    period: int = None,
+    buffer=DEFAULT_BUFFER,
+    logger=None,
+    silence_aware: bool = False,
 ):
+    if logger is None:
+        logger = loguru.logger
     if isinstance(audio, (str, BytesIO, BinaryIO)):
         logger.debug(f"Loading audio from {audio}")
         audio = AudioSegment.from_file(audio)
-    if logger is None:
-        logger = loguru.logger
-    chunks = []
-    s = 0
-
-    if len(audio) / period > WHISPER_RATE_LIMIT - 5:
-        period = len(audio) // (WHISPER_RATE_LIMIT - 5)
 
     logger.debug(f"Splitting audio into chunks")
-    while s + period < len(audio):
-        chunks.append(audio[s : s + period])
-        s += period - buffer
-    chunks.append(audio[s:])
+    boundaries = _plan_audio_chunks(audio, period, buffer, silence_aware)
+    chunks = [audio[s:e] for s, e in boundaries]
     logger.debug(f"Split into {len(chunks)} chunks")
 
     in_memory_audio_files = []
@@ -44,40 +238,427 @@ def split_audio(
     logger.debug(f"Converting chunks to mp3")
     for i, chunk in enumerate(chunks):
         buffer = BytesIO()
-        chunk.export(buffer, format="mp3")  # check which format it is and
-        # use the same
+        chunk.export(buffer, format="mp3", bitrate=f"{CHUNK_BITRATE // 1000}k")
+        # todo: check which format it is and use the same
         buffer.name = f"chunk_{i}.mp3"
+        buffer.duration = chunk.duration_seconds  # metered by the whisper limiter
         in_memory_audio_files.append(buffer)
     logger.debug(f"Converted chunks to mp3")
 
     return in_memory_audio_files
 
 
+# ------------------ Streaming split ------------------ #
+
+
+@contextmanager
+def _audio_file_path(audio: Audio):
+    """
+    ffmpeg needs a seekable file to cut chunks - spill in-memory audio to disk
+    """
+    if isinstance(audio, (str, Path)):
+        yield str(audio)
+        return
+    fd, path = mkstemp(suffix=Path(getattr(audio, "name", "") or "").suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            audio.seek(0)
+            shutil.copyfileobj(audio, f)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def get_audio_duration(path) -> int:
+    """
+    Audio duration in ms, read from the container metadata without decoding
+    """
+    info = mediainfo_json(str(path))
+    return int(float(info["format"]["duration"]) * 1000)
+
+
+def _ffmpeg_export_cmd(path, start: int, end: int, format="mp3") -> List[str]:
+    return [
+        get_encoder_name(),
+        "-nostdin",
+        "-v",
+        "error",
+        # input seeking - ffmpeg jumps to the start instead of decoding up to it
+        "-ss",
+        f"{start / 1000:.3f}",
+        "-t",
+        f"{(end - start) / 1000:.3f}",
+        "-i",
+        str(path),
+        "-vn",
+        "-b:a",
+        f"{CHUNK_BITRATE // 1000}k",
+        "-f",
+        format,
+        "pipe:1",
+    ]
+
+
+def export_chunk_with_ffmpeg(path, start: int, end: int, format="mp3") -> BytesIO:
+    """
+    Decode and encode only the [start, end) ms range of the file
+    """
+    cmd = _ffmpeg_export_cmd(path, start, end, format=format)
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"ffmpeg failed to export chunk {start}-{end}: "
+            f"{result.stderr.decode('utf-8', errors='replace')}"
+        )
+    return BytesIO(result.stdout)
+
+
+async def aexport_chunk_with_ffmpeg(
+    path, start: int, end: int, format="mp3"
+) -> BytesIO:
+    """
+    Async version of export_chunk_with_ffmpeg - doesn't block the event loop
+    """
+    cmd = _ffmpeg_export_cmd(path, start, end, format=format)
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"ffmpeg failed to export chunk {start}-{end}: "
+            f"{stderr.decode('utf-8', errors='replace')}"
+        )
+    return BytesIO(stdout)
+
+
+def iter_split_audio(
+    audio: Audio,
+    period: int = None,
+    buffer=DEFAULT_BUFFER,
+    logger=None,
+    silence_aware: bool = False,
+) -> Iterator[BytesIO]:
+    """
+    Streaming version of split_audio
+    Yields encoded mp3 chunks one by one, cutting each directly from the file with
+    ffmpeg - the whole audio is never decoded into memory.
+    """
+    if logger is None:
+        logger = loguru.logger
+    if isinstance(audio, AudioSegment):
+        # already decoded - nothing to save, fall back to the regular split
+        yield from split_audio(
+            audio,
+            period=period,
+            buffer=buffer,
+            logger=logger,
+            silence_aware=silence_aware,
+        )
+        return
+
+    with _audio_file_path(audio) as path:
+        boundaries = _plan_file_chunks(path, period, buffer, silence_aware)
+        logger.debug(f"Streaming audio in {len(boundaries)} chunks")
+        for i, (start, end) in enumerate(boundaries):
+            chunk = export_chunk_with_ffmpeg(path, start, end)
+            chunk.name = f"chunk_{i}.mp3"
+            chunk.duration = (end - start) / 1000
+            yield chunk
+
+
+# ------------------ Parallel encoding ------------------ #
+
+_encoding_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_encoding_executor(max_workers: int = None) -> ProcessPoolExecutor:
+    """
+    Shared process pool for encoding audio chunks. Created on first use
+    """
+    global _encoding_executor
+    if _encoding_executor is None:
+        # spawn - forking a process with running threads (log writer, mongo
+        # pool) can deadlock the child
+        _encoding_executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _encoding_executor
+
+
+def shutdown_encoding_executor():
+    global _encoding_executor
+    if _encoding_executor is not None:
+        _encoding_executor.shutdown(cancel_futures=True)
+        _encoding_executor = None
+
+
+atexit.register(shutdown_encoding_executor)
+
+
+def _export_segment(segment: AudioSegment, format="mp3") -> bytes:
+    # runs in a worker process - return plain bytes, they pickle cheaply
+    buffer = BytesIO()
+    segment.export(buffer, format=format, bitrate=f"{CHUNK_BITRATE // 1000}k")
+    return buffer.getvalue()
+
+
+async def _iter_in_order(
+    factories: Iterable[Callable[[], Awaitable]], window: int
+) -> AsyncIterator:
+    """
+    Run up to `window` jobs at once and yield results in the original order
+    as soon as each of them is ready
+    """
+    factories = iter(factories)
+    pending = deque(
+        asyncio.ensure_future(factory()) for factory in islice(factories, window)
+    )
+    try:
+        while pending:
+            result = await pending.popleft()
+            factory = next(factories, None)
+            if factory is not None:
+                pending.append(asyncio.ensure_future(factory()))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def aiter_split_audio(
+    audio: Audio,
+    period: int = None,
+    buffer=DEFAULT_BUFFER,
+    logger=None,
+    streaming: bool = False,
+    executor: Executor = None,
+    max_workers: int = None,
+    silence_aware: bool = False,
+) -> AsyncIterator[BytesIO]:
+    """
+    Async version of split_audio - the event loop stays responsive
+    Chunks are encoded in parallel and yielded in order as they're ready:
+    - on a process pool for decoded audio
+    - as parallel ffmpeg processes in streaming mode
+    """
+    if logger is None:
+        logger = loguru.logger
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if streaming and not isinstance(audio, AudioSegment):
+        with _audio_file_path(audio) as path:
+            boundaries = await asyncio.to_thread(
+                _plan_file_chunks, path, period, buffer, silence_aware
+            )
+            logger.debug(f"Streaming audio in {len(boundaries)} chunks")
+            factories = [
+                lambda s=s, e=e: aexport_chunk_with_ffmpeg(path, s, e)
+                for s, e in boundaries
+            ]
+            i = 0
+            async for chunk in _iter_in_order(factories, max_workers):
+                chunk.name = f"chunk_{i}.mp3"
+                chunk.duration = (boundaries[i][1] - boundaries[i][0]) / 1000
+                i += 1
+                yield chunk
+        return
+
+    if isinstance(audio, (str, BytesIO, BinaryIO)):
+        logger.debug(f"Loading audio from {audio}")
+        audio = await asyncio.to_thread(AudioSegment.from_file, audio)
+    if executor is None:
+        executor = get_encoding_executor(max_workers)
+
+    loop = asyncio.get_running_loop()
+    boundaries = await asyncio.to_thread(
+        _plan_audio_chunks, audio, period, buffer, silence_aware
+    )
+    logger.debug(f"Encoding {len(boundaries)} chunks in parallel")
+    # slice lazily, so that only the chunks in flight are copied
+    factories = [
+        lambda s=s, e=e: loop.run_in_executor(executor, _export_segment, audio[s:e])
+        for s, e in boundaries
+    ]
+    i = 0
+    async for data in _iter_in_order(factories, max_workers):
+        chunk = BytesIO(data)
+        chunk.name = f"chunk_{i}.mp3"
+        chunk.duration = (boundaries[i][1] - boundaries[i][0]) / 1000
+        i += 1
+        yield chunk
+
+
+# --------------------------------------------- #
+
+
+def _chunk_cache_key(chunk: BytesIO) -> str:
+    return f"chunk:{hash_bytes(chunk.getvalue())}"
+
+
+async def _atranscribe_chunk(
+    chunk: BytesIO,
+    cache: TieredCache = None,
+    scheduler: FairScheduler = None,
+    scheduler_key=None,
+) -> str:
+    if cache is not None:
+        key = _chunk_cache_key(chunk)
+        text = await cache.aget(key)
+        if text is not None:
+            return text
+    duration = getattr(chunk, "duration", None)
+    if scheduler is None:
+        text = await atranscribe_audio(chunk, duration=duration)
+    else:
+        text = await scheduler.run(
+            scheduler_key, atranscribe_audio, chunk, duration=duration
+        )
+    if cache is not None:
+        await cache.aset(key, text)
+    return text
+
+
+async def aiter_transcribe_audio(
+    audio: Audio,
+    period: int = None,
+    buffer: int = DEFAULT_BUFFER,
+    parallel: bool = None,
+    logger=None,
+    streaming: bool = False,
+    executor: Executor = None,
+    max_workers: int = None,
+    cache: TieredCache = None,
+    silence_aware: bool = False,
+    scheduler: FairScheduler = None,
+    scheduler_key=None,
+) -> AsyncIterator[str]:
+    """
+    Transcribe chunks while the later chunks are still being cut and encoded
+    Yields text chunks in order, each as soon as it's transcribed
+    parallel=False - chunks are transcribed one at a time, but still overlap
+    with encoding of the next ones
+    """
+    if logger is None:
+        logger = loguru.logger
+    semaphore = None if parallel else asyncio.Semaphore(1)
+
+    async def transcribe(chunk):
+        if semaphore is None:
+            return await _atranscribe_chunk(chunk, cache, scheduler, scheduler_key)
+        async with semaphore:
+            return await _atranscribe_chunk(chunk, cache, scheduler, scheduler_key)
+
+    tasks = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for chunk in aiter_split_audio(
+                audio,
+                period=period,
+                buffer=buffer,
+                logger=logger,
+                streaming=streaming,
+                executor=executor,
+                max_workers=max_workers,
+                silence_aware=silence_aware,
+            ):
+                tasks.put_nowait(asyncio.create_task(transcribe(chunk)))
+        finally:
+            tasks.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    started = []
+    try:
+        while (task := await tasks.get()) is not None:
+            started.append(task)
+            yield await task
+        await producer  # re-raise splitting errors, if any
+    finally:
+        producer.cancel()
+        while not tasks.empty():
+            started.append(tasks.get_nowait())
+        for task in started:
+            if task is not None:
+                task.cancel()
+
+
 async def split_and_transcribe_audio(
     audio: Audio,
-    period: int = DEFAULT_PERIOD,
+    period: int = None,
     buffer: int = DEFAULT_BUFFER,
     parallel: bool = None,
     logger=None,
+    streaming: bool = False,
+    executor: Executor = None,
+    max_workers: int = None,
+    pipelined: bool = False,
+    cache: TieredCache = None,
+    silence_aware: bool = False,
+    scheduler: FairScheduler = None,
+    scheduler_key=None,
 ):
+    """
+    period - chunk length in ms. By default 2 minutes, or with silence_aware
+    as long as the whisper upload limit allows
+    cache - transcriptions of encoded chunks, keyed by the chunk hash
+    silence_aware - cut chunks in pauses instead of fixed overlapping steps
+    scheduler - shared whisper request scheduler, fair between scheduler_keys
+    """
     if logger is None:
         logger = loguru.logger
 
-    if isinstance(audio, (str, BytesIO, BinaryIO)):
-        logger.debug(f"Loading audio from {audio}")
-        audio = AudioSegment.from_file(audio)
+    if pipelined:
+        logger.info("Transcribing chunks while splitting")
+        text_chunks = [
+            text
+            async for text in aiter_transcribe_audio(
+                audio,
+                period=period,
+                buffer=buffer,
+                parallel=parallel,
+                logger=logger,
+                streaming=streaming,
+                executor=executor,
+                max_workers=max_workers,
+                cache=cache,
+                silence_aware=silence_aware,
+                scheduler=scheduler,
+                scheduler_key=scheduler_key,
+            )
+        ]
+        logger.debug(f"Parsed audio", data=lambda: pprint.pformat(text_chunks))
+        return text_chunks
 
-    audio_chunks = split_audio(audio, period=period, buffer=buffer, logger=logger)
+    audio_chunks = [
+        chunk
+        async for chunk in aiter_split_audio(
+            audio,
+            period=period,
+            buffer=buffer,
+            logger=logger,
+            streaming=streaming,
+            executor=executor,
+            max_workers=max_workers,
+            silence_aware=silence_aware,
+        )
+    ]
 
     if parallel:
         logger.info("Processing chunks in parallel")
-        tasks = map(atranscribe_audio, audio_chunks)
+        tasks = [
+            _atranscribe_chunk(chunk, cache, scheduler, scheduler_key)
+            for chunk in audio_chunks
+        ]
         text_chunks = await asyncio.gather(*tasks)
     else:
         logger.info("Processing chunks sequentially")
         text_chunks = []
         for chunk in tqdm.std.tqdm(audio_chunks):
-            text_chunks.append(transcribe_audio(chunk))
+            text_chunks.append(
+                await _atranscribe_chunk(chunk, cache, scheduler, scheduler_key)
+            )
 
-    logger.debug(f"Parsed audio", data=pprint.pformat(text_chunks))
+    logger.debug(f"Parsed audio", data=lambda: pprint.pformat(text_chunks))
     return text_chunks
@@ -0,0 +1,232 @@
+"""
+Caching helpers: an in-memory LRU tier and an optional persistent Mongo tier
+
+cache = TieredCache(LRUCache(max_size=1024, ttl=3600),
+                    MongoCache("transcriptions", max_size=100_000, ttl=30 * 86400))
+cache.set("key", value)
+cache.get("key")
+await cache.aget("key")  # persistent tier is queried in a thread
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import mongoengine
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_text(text: str) -> str:
+    return hash_bytes(text.encode("utf-8"))
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    In-memory cache with LRU eviction and optional TTL (in seconds)
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self._items[key] = (expires_at, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ThreadSafeLRUCache(LRUCache):
+    """
+    LRUCache shared between the event loop and worker threads
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            super().set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            super().delete(key)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+
+class CacheItem(mongoengine.Document):
+    namespace = mongoengine.StringField(required=True)
+    key = mongoengine.StringField(required=True)
+    value = mongoengine.DynamicField()
+    created_at = mongoengine.DateTimeField()
+    # mongo removes expired items on its own with the TTL index
+    expires_at = mongoengine.DateTimeField()
+
+    meta = {
+        "collection": os.getenv("CACHE_MONGO_COLLECTION", "cache"),
+        "indexes": [
+            {"fields": ["namespace", "key"], "unique": True},
+            {"fields": ["expires_at"], "expireAfterSeconds": 0},
+            ("namespace", "-created_at"),
+        ],
+    }
+
+
+class MongoCache:
+    """
+    Persistent cache tier in the app database
+    Items expire with a TTL index, the oldest items are evicted above max_size
+    """
+
+    # check the namespace size once per this many writes
+    EVICTION_CHECK_PERIOD = 100
+
+    def __init__(
+        self,
+        namespace: str,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        document_class=CacheItem,
+    ):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.document_class = document_class
+        self._writes = 0
+
+    def _objects(self, **filters):
+        return self.document_class.objects(namespace=self.namespace, **filters)
+
+    def get(self, key, default=None):
+        item = self._objects(key=key).only("value", "expires_at").first()
+        if item is None:
+            return default
+        # the TTL monitor runs once a minute - don't serve stale items meanwhile
+        if item.expires_at is not None and item.expires_at < datetime.utcnow():
+            return default
+        return item.value
+
+    def set(self, key, value):
+        now = datetime.utcnow()
+        expires_at = None if self.ttl is None else now + timedelta(seconds=self.ttl)
+        self._objects(key=key).update_one(
+            upsert=True,
+            set__value=value,
+            set__created_at=now,
+            set__expires_at=expires_at,
+        )
+        self._writes += 1
+        if self.max_size is not None and (
+            self._writes % self.EVICTION_CHECK_PERIOD == 0
+        ):
+            self.evict()
+
+    def delete(self, key):
+        self._objects(key=key).delete()
+
+    def evict(self):
+        """
+        Remove the oldest items above max_size
+        """
+        stale_ids = list(
+            self._objects().order_by("-created_at").skip(self.max_size).scalar("id")
+        )
+        if stale_ids:
+            self.document_class.objects(id__in=stale_ids).delete()
+
+    def clear(self):
+        self._objects().delete()
+
+
+class TieredCache:
+    """
+    Check the in-memory tier first, then the persistent one
+    Persistent hits are promoted to memory
+    """
+
+    def __init__(self, memory: LRUCache = None, persistent: MongoCache = None):
+        if memory is None:
+            memory = LRUCache()
+        self.memory = memory
+        self.persistent = persistent
+
+    def get(self, key, default=None) -> Any:
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.persistent is not None:
+            value = self.persistent.get(key, _MISSING)
+            if value is not _MISSING:
+                self.memory.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            self.persistent.set(key, value)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.persistent is not None:
+            self.persistent.delete(key)
+
+    async def aget(self, key, default=None) -> Any:
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.persistent is None:
+            return default
+        value = await asyncio.to_thread(self.persistent.get, key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.memory.set(key, value)
+        return value
+
+    async def aset(self, key, value):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            await asyncio.to_thread(self.persistent.set, key, value)
@@ -0,0 +1,282 @@
+"""
+Parallel multi-part downloads of large telegram media with pyrogram
+
+The file is split into byte-range parts (multiples of pyrogram's 1 MiB chunk),
+parts are fetched concurrently with upload.GetFile over one media session per
+DC and written into a preallocated memory-mapped file.
+(client.stream_media opens a new session - and for a foreign DC a new auth
+key and authorization export - on every call, i.e. for every part)
+Finished parts are recorded in a `<target>.parts` state file, so an interrupted
+download resumes from where it stopped.
+"""
+import asyncio
+import json
+import math
+import mmap
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, NamedTuple
+
+import loguru
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Auth, Session
+
+PYROGRAM_CHUNK_SIZE = 1024 * 1024  # pyrogram streams media in 1 MiB chunks
+DEFAULT_PART_SIZE = 8 * PYROGRAM_CHUNK_SIZE
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PER_DC_LIMIT = 4
+
+MEDIA_ATTRIBUTES = ["audio", "voice", "video", "video_note", "document", "animation"]
+
+
+class Part(NamedTuple):
+    index: int
+    start: int  # bytes
+    length: int  # bytes
+    offset: int  # pyrogram chunks
+    limit: int  # pyrogram chunks
+
+
+def get_message_media(message):
+    for attr in MEDIA_ATTRIBUTES:
+        media = getattr(message, attr, None)
+        if media:
+            return media
+    raise ValueError("No media found in the message")
+
+
+def split_into_parts(file_size: int, part_size: int = DEFAULT_PART_SIZE) -> List[Part]:
+    if part_size % PYROGRAM_CHUNK_SIZE:
+        raise ValueError(f"Part size must be a multiple of {PYROGRAM_CHUNK_SIZE}")
+    chunks_per_part = part_size // PYROGRAM_CHUNK_SIZE
+    parts = []
+    for index in range(math.ceil(file_size / part_size)):
+        start = index * part_size
+        parts.append(
+            Part(
+                index=index,
+                start=start,
+                length=min(part_size, file_size - start),
+                offset=index * chunks_per_part,
+                limit=chunks_per_part,
+            )
+        )
+    return parts
+
+
+def get_file_location(file_id: FileId):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size,
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size,
+    )
+
+
+class MediaSessionPool:
+    """
+    One started and authorized media session per DC, shared by all parts
+    Requests are multiplexed over the session, like pyrogram does it
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._sessions: Dict[int, Session] = {}
+        self._locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def get(self, dc_id: int) -> Session:
+        async with self._locks[dc_id]:
+            if dc_id not in self._sessions:
+                self._sessions[dc_id] = await self._create_session(dc_id)
+            return self._sessions[dc_id]
+
+    async def _create_session(self, dc_id: int) -> Session:
+        client = self.client
+        test_mode = await client.storage.test_mode()
+        is_home_dc = dc_id == await client.storage.dc_id()
+        if is_home_dc:
+            auth_key = await client.storage.auth_key()
+        else:
+            auth_key = await Auth(client, dc_id, test_mode).create()
+        session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+        if not is_home_dc:
+            exported = await client.invoke(
+                raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+            )
+            await session.invoke(
+                raw.functions.auth.ImportAuthorization(
+                    id=exported.id, bytes=exported.bytes
+                )
+            )
+        return session
+
+    async def stop(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            await session.stop()
+
+
+def _get_state_path(target_path: Path) -> Path:
+    return target_path.with_name(target_path.name + ".parts")
+
+
+def _load_state(state_path: Path, file_size: int, part_size: int) -> set:
+    if not state_path.exists():
+        return set()
+    try:
+        state = json.loads(state_path.read_text())
+    except ValueError:
+        return set()
+    if state.get("file_size") != file_size or state.get("part_size") != part_size:
+        # different file or different layout - start over
+        return set()
+    return set(state["done"])
+
+
+def _save_state(state_path: Path, file_size: int, part_size: int, done: set):
+    tmp_path = state_path.with_name(state_path.name + ".tmp")
+    state = {"file_size": file_size, "part_size": part_size, "done": sorted(done)}
+    tmp_path.write_text(json.dumps(state))
+    os.replace(tmp_path, state_path)
+
+
+class ParallelDownloader:
+    """
+    Download large media as many byte-range parts at once
+
+    concurrency - max parts in flight for a single file
+    per_dc_limit - max parts in flight per telegram DC, shared by all downloads
+    sessions - media sessions to download with, one per DC by default
+    """
+
+    def __init__(
+        self,
+        client,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        per_dc_limit: int = DEFAULT_PER_DC_LIMIT,
+        part_size: int = DEFAULT_PART_SIZE,
+        sessions: MediaSessionPool = None,
+        logger=None,
+    ):
+        self.client = client
+        if sessions is None:
+            sessions = MediaSessionPool(client)
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.per_dc_limit = per_dc_limit
+        self.part_size = part_size
+        if logger is None:
+            logger = loguru.logger
+        self.logger = logger
+        self._dc_semaphores: Dict[int, asyncio.Semaphore] = {}
+
+    def _get_dc_semaphore(self, dc_id: int) -> asyncio.Semaphore:
+        if dc_id not in self._dc_semaphores:
+            self._dc_semaphores[dc_id] = asyncio.Semaphore(self.per_dc_limit)
+        return self._dc_semaphores[dc_id]
+
+    async def _iter_part(self, message, file_id: FileId, part: Part) -> AsyncIterator:
+        session = await self.sessions.get(file_id.dc_id)
+        location = get_file_location(file_id)
+        position = part.start
+        end = part.start + part.length
+        while position < end:
+            r = await session.invoke(
+                raw.functions.upload.GetFile(
+                    location=location, offset=position, limit=PYROGRAM_CHUNK_SIZE
+                ),
+                sleep_threshold=30,
+            )
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                # served from a CDN - rare for bot files, let pyrogram handle it
+                offset = position // PYROGRAM_CHUNK_SIZE
+                async for chunk in self.client.stream_media(
+                    message, offset=offset, limit=part.offset + part.limit - offset
+                ):
+                    yield chunk
+                return
+            if not r.bytes:
+                return
+            yield r.bytes
+            position += len(r.bytes)
+            if len(r.bytes) < PYROGRAM_CHUNK_SIZE:
+                return
+
+    async def close(self):
+        await self.sessions.stop()
+
+    async def download(self, message, target_path) -> Path:
+        """
+        Download the media of a pyrogram message to target_path
+        Resumes a partial download if a matching state file exists
+        """
+        media = get_message_media(message)
+        file_size = media.file_size
+        file_id = FileId.decode(media.file_id)
+        dc_id = file_id.dc_id
+        target_path = Path(target_path)
+        state_path = _get_state_path(target_path)
+
+        parts = split_into_parts(file_size, self.part_size)
+        done = set()
+        if target_path.exists():
+            done = _load_state(state_path, file_size, self.part_size)
+        pending = [part for part in parts if part.index not in done]
+        self.logger.debug(
+            f"Downloading {file_size} bytes in {len(parts)} parts "
+            f"({len(pending)} pending) from DC {dc_id}"
+        )
+
+        # preallocate the file
+        with open(target_path, "r+b" if target_path.exists() else "w+b") as f:
+            f.truncate(file_size)
+
+        if pending:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            dc_semaphore = self._get_dc_semaphore(dc_id)
+
+            with open(target_path, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm:
+
+                async def fetch(part: Part):
+                    async with semaphore, dc_semaphore:
+                        position = part.start
+                        async for chunk in self._iter_part(message, file_id, part):
+                            mm[position : position + len(chunk)] = chunk
+                            position += len(chunk)
+                    received = position - part.start
+                    if received != part.length:
+                        raise IOError(
+                            f"Part {part.index}: expected {part.length} bytes, "
+                            f"received {received}"
+                        )
+                    mm.flush(part.start, part.length)
+                    done.add(part.index)
+                    _save_state(state_path, file_size, self.part_size, done)
+
+                tasks = [asyncio.create_task(fetch(part)) for part in pending]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    # don't leave parts writing into a closed map on failure
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+        actual_size = target_path.stat().st_size
+        if actual_size != file_size or len(done) != len(parts):
+            raise IOError(
+                f"Download incomplete: {actual_size} of {file_size} bytes, "
+                f"{len(done)} of {len(parts)} parts"
+            )
+        state_path.unlink(missing_ok=True)
+        return target_path
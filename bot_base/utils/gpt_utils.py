@@ -1,19 +1,27 @@
 import asyncio
 import json
-from functools import partial
+from functools import lru_cache
 from io import BytesIO
-from typing import Union, BinaryIO
+from typing import AsyncIterator, BinaryIO, List, Optional, Union
 
 import loguru
 import openai
 import pydub
 import tiktoken
-from aiolimiter import AsyncLimiter
 
-WHISPER_RATE_LIMIT = 50  # 50 requests per minute
-whisper_limiter = AsyncLimiter(WHISPER_RATE_LIMIT, 60)  # 50 requests per minute
-GPT_RATE_LIMIT = 200  # 200 requests per minute
-gpt_limiter = AsyncLimiter(GPT_RATE_LIMIT, 60)  # 200 requests per minute
+from bot_base.utils.async_utils import SingleFlight
+from bot_base.utils.cache_utils import ThreadSafeLRUCache, TieredCache, hash_text
+from bot_base.utils.rate_limit_utils import (
+    DEFAULT_LIMITS,
+    call_with_rate_limit,
+    rate_limiters,
+)
+
+# requests and tokens / audio seconds per minute, see rate_limit_utils
+WHISPER_RATE_LIMIT = DEFAULT_LIMITS["whisper-1"].requests_per_minute
+whisper_limiter = rate_limiters.get("whisper-1")
+GPT_RATE_LIMIT = DEFAULT_LIMITS["gpt-3.5-turbo"].requests_per_minute
+gpt_limiter = rate_limiters.get("gpt-3.5-turbo")
 
 
 # Then use atranscribe_audio_limited instead of atranscribe_audio
@@ -25,35 +33,169 @@ token_limit_by_model = {
 }
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    # To get the tokeniser corresponding to a specific model in the OpenAI API:
+    return tiktoken.encoding_for_model(model)
+
+
+TOKEN_COUNT_CACHE_SIZE = 10_000
+# (model, text hash) -> token count, also used from asyncio.to_thread
+_token_count_cache = ThreadSafeLRUCache(max_size=TOKEN_COUNT_CACHE_SIZE)
+
+
 def get_token_count(text, model="gpt-3.5-turbo"):
     """
     calculate amount of tokens in text
     model: gpt-3.5-turbo, gpt-4
     """
-    # To get the tokeniser corresponding to a specific model in the OpenAI API:
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
+    key = (model, hash_text(text))
+    count = _token_count_cache.get(key)
+    if count is None:
+        count = len(get_encoding(model).encode(text))
+        _token_count_cache.set(key, count)
+    return count
+
+
+def get_token_counts(texts, model="gpt-3.5-turbo", num_threads=8) -> List[int]:
+    """
+    Batch version of get_token_count
+    Texts missing from the cache are tokenized with one encode_batch call
+    on a thread pool
+    """
+    keys = [(model, hash_text(text)) for text in texts]
+    counts = [_token_count_cache.get(key) for key in keys]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        encoded = get_encoding(model).encode_batch(
+            [texts[i] for i in missing], num_threads=num_threads
+        )
+        for i, tokens in zip(missing, encoded):
+            counts[i] = len(tokens)
+            _token_count_cache.set(keys[i], counts[i])
+    return counts
+
+
+# completion key -> response text. Off unless set with set_completion_cache,
+# App sets it up from its config
+completion_cache: Optional[TieredCache] = None
+_completion_flights = SingleFlight()
+
+
+def set_completion_cache(cache: Optional[TieredCache]):
+    """
+    Set the cache used by run_command_with_gpt, None disables caching
+    """
+    global completion_cache
+    completion_cache = cache
+
+
+def get_completion_key(command: str, data: str, model="gpt-3.5-turbo") -> str:
+    return hash_text(json.dumps([model, command, data], ensure_ascii=False))
 
 
 # todo: add retry in case of error. Or at least handle gracefully
-def run_command_with_gpt(command: str, data: str, model="gpt-3.5-turbo"):
+def run_command_with_gpt(
+    command: str, data: str, model="gpt-3.5-turbo", use_cache=True
+):
+    cache = completion_cache if use_cache else None
+    if cache is not None:
+        key = get_completion_key(command, data, model=model)
+        result = cache.get(key)
+        if result is not None:
+            return result
     messages = [
         {"role": "system", "content": command},
         {"role": "user", "content": data},
     ]
     response = openai.ChatCompletion.create(messages=messages, model=model)
+    result = response.choices[0].message.content
+    if cache is not None:
+        cache.set(key, result)
+    return result
+
+
+async def _arun_command_with_gpt(command: str, data: str, model="gpt-3.5-turbo"):
+    messages = [
+        {"role": "system", "content": command},
+        {"role": "user", "content": data},
+    ]
+    # reserve the prompt tokens - the completion is billed after the fact
+    prompt_tokens = get_token_count(command, model=model) + get_token_count(
+        data, model=model
+    )
+    response = await call_with_rate_limit(
+        rate_limiters.get(model),
+        openai.ChatCompletion.acreate,
+        messages=messages,
+        model=model,
+        units=prompt_tokens,
+    )
     return response.choices[0].message.content
 
 
+async def _arun_and_cache(cache: TieredCache, key, command, data, model):
+    result = await _arun_command_with_gpt(command, data, model=model)
+    await cache.aset(key, result)
+    return result
+
+
 # todo: if reason is length - continue generation
-async def arun_command_with_gpt(command: str, data: str, model="gpt-3.5-turbo"):
+async def arun_command_with_gpt(
+    command: str, data: str, model="gpt-3.5-turbo", use_cache=True
+):
+    """
+    Identical concurrent calls share one request, results are cached
+    """
+    cache = completion_cache if use_cache else None
+    if cache is None:
+        return await _arun_command_with_gpt(command, data, model=model)
+    key = get_completion_key(command, data, model=model)
+    result = await cache.aget(key)
+    if result is not None:
+        return result
+    return await _completion_flights.run(
+        key, _arun_and_cache, cache, key, command, data, model
+    )
+
+
+async def astream_command_with_gpt(
+    command: str, data: str, model="gpt-3.5-turbo", use_cache=True
+) -> AsyncIterator[str]:
+    """
+    Yield the completion as it's generated, in text deltas
+    A cached result is yielded whole
+    """
+    cache = completion_cache if use_cache else None
+    if cache is not None:
+        key = get_completion_key(command, data, model=model)
+        result = await cache.aget(key)
+        if result is not None:
+            yield result
+            return
     messages = [
         {"role": "system", "content": command},
         {"role": "user", "content": data},
     ]
-    async with gpt_limiter:
-        response = await openai.ChatCompletion.acreate(messages=messages, model=model)
-    return response.choices[0].message.content
+    prompt_tokens = get_token_count(command, model=model) + get_token_count(
+        data, model=model
+    )
+    response = await call_with_rate_limit(
+        rate_limiters.get(model),
+        openai.ChatCompletion.acreate,
+        messages=messages,
+        model=model,
+        stream=True,
+        units=prompt_tokens,
+    )
+    result = ""
+    async for chunk in response:
+        delta = chunk.choices[0].delta.get("content")
+        if delta:
+            result += delta
+            yield delta
+    if cache is not None:
+        await cache.aset(key, result)
 
 
 Audio = Union[pydub.AudioSegment, BytesIO, BinaryIO, str]
@@ -65,11 +207,21 @@ def transcribe_audio(audio: Audio, model="whisper-1"):
     return openai.Audio.transcribe(model, audio).text
 
 
-async def atranscribe_audio(audio: Audio, model="whisper-1"):
+async def atranscribe_audio(audio: Audio, model="whisper-1", duration: float = None):
+    """
+    duration - in seconds, metered against the audio limit if known
+    """
+    if duration is None and isinstance(audio, pydub.AudioSegment):
+        duration = audio.duration_seconds
     if isinstance(audio, str):
         audio = open(audio)
-    async with whisper_limiter:
-        result = await openai.Audio.atranscribe(model, audio)
+    result = await call_with_rate_limit(
+        rate_limiters.get(model),
+        openai.Audio.atranscribe,
+        model,
+        audio,
+        units=duration or 0,
+    )
     return result.text
 
 
@@ -101,33 +253,149 @@ def split_by_weight(items, weight_func, limit):
     return groups
 
 
-async def apply_command_recursively(
-    command, chunks, model="gpt-3.5-turbo", merger=None, logger=None
+MAP_REDUCE_MAX_RETRIES = 2
+MAP_REDUCE_RETRY_DELAY = 1  # seconds, doubled on each retry
+_LEVEL_END = object()
+
+
+async def amap_reduce_gpt_command(
+    command,
+    chunks,
+    model="gpt-3.5-turbo",
+    merger=None,
+    logger=None,
+    on_progress=None,
+    max_retries=MAP_REDUCE_MAX_RETRIES,
 ):
     """
-    Apply GPT command recursively to the data
+    Apply GPT command to the data as a tree of merges
+    Chunks are grouped in order into groups that fit the model's context window.
+    Each level consumes the results of the previous one as they arrive and fires
+    a merge node as soon as its group is full - without waiting for the rest of
+    the level. So the latency follows the tree depth, not the slowest node of
+    every round.
+
+    on_progress(done, started) - called after each finished node
+    max_retries - per node, a failed node is retried without redoing the others
     """
     if logger is None:
         logger = loguru.logger
     if merger is None:
         merger = default_merger
     token_limit = token_limit_by_model[model]
-    while len(chunks) > 1:
-        groups = split_by_weight(
-            chunks, partial(get_token_count, model=model), token_limit
-        )
-        if len(groups) == len(chunks):
-            raise ValueError(
-                f"Chunk size is too big for model {model} with limit {token_limit}"
+    chunks = list(chunks)
+    if not chunks:
+        raise ValueError("No chunks to apply the command to")
+    if len(chunks) == 1:
+        return chunks[0]
+    # tokenize the first level in one batch, off the event loop
+    await asyncio.to_thread(get_token_counts, chunks, model=model)
+
+    loop = asyncio.get_running_loop()
+    nodes = []
+    progress = {"started": 0, "done": 0}
+
+    async def run_node(group):
+        data = merger(group)
+        for attempt in range(max_retries + 1):
+            try:
+                result = await arun_command_with_gpt(command, data, model=model)
+                break
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"Node failed, retrying ({attempt + 1}): {e}")
+                await asyncio.sleep(MAP_REDUCE_RETRY_DELAY * 2**attempt)
+        progress["done"] += 1
+        logger.debug(f"Node {progress['done']}/{progress['started']} done", data=result)
+        if on_progress is not None:
+            on_progress(progress["done"], progress["started"])
+        return result
+
+    def start_node(group, out: asyncio.Queue):
+        progress["started"] += 1
+        node = asyncio.create_task(run_node(group))
+        nodes.append(node)
+        out.put_nowait(node)
+
+    async def reduce_level(prefix, items: asyncio.Queue, out: asyncio.Queue):
+        try:
+            group = []
+            group_weight = 0
+            n_items = 0
+            n_groups = 0
+
+            async def next_item():
+                return prefix.pop(0) if prefix else await items.get()
+
+            while (item := await next_item()) is not _LEVEL_END:
+                result = await item
+                n_items += 1
+                weight = _token_count_cache.get((model, hash_text(result)))
+                if weight is None:  # a node result - tokenize off the event loop
+                    weight = await asyncio.to_thread(get_token_count, result, model)
+                if weight > token_limit:
+                    raise ValueError(
+                        f"Item {result} is too big to fit into a single group "
+                        f"with limit {token_limit}"
+                    )
+                if group and group_weight + weight > token_limit:
+                    start_node(group, out)
+                    n_groups += 1
+                    group = []
+                    group_weight = 0
+                group.append(result)
+                group_weight += weight
+            if group:
+                start_node(group, out)
+                n_groups += 1
+            if n_groups == n_items:
+                raise ValueError(
+                    f"Chunk size is too big for model {model} with limit {token_limit}"
+                )
+        except BaseException as e:
+            # pass the error up the tree instead of leaving the next level hanging
+            failed = loop.create_future()
+            failed.set_exception(e)
+            out.put_nowait(failed)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            out.put_nowait(_LEVEL_END)
+
+    level = asyncio.Queue()
+    for chunk in chunks:
+        done = loop.create_future()
+        done.set_result(chunk)
+        level.put_nowait(done)
+    level.put_nowait(_LEVEL_END)
+
+    workers = []
+    try:
+        while True:
+            first = await level.get()
+            second = await level.get()
+            if second is _LEVEL_END:
+                return await first
+            next_level = asyncio.Queue()
+            workers.append(
+                asyncio.create_task(reduce_level([first, second], level, next_level))
             )
-        logger.debug(f"Split into {len(groups)} groups")
-        # apply merger
-        merged_chunks = map(merger, groups)
-        # apply command
-        chunks = await amap_gpt_command(merged_chunks, command, model=model)
-        logger.debug(f"Intermediate Result: {chunks}")
+            level = next_level
+    finally:
+        for task in workers + nodes:
+            task.cancel()
+
 
-    return chunks[0]
+async def apply_command_recursively(
+    command, chunks, model="gpt-3.5-turbo", merger=None, logger=None
+):
+    """
+    Apply GPT command recursively to the data
+    """
+    return await amap_reduce_gpt_command(
+        command, chunks, model=model, merger=merger, logger=logger
+    )
 
 
 def map_gpt_command(
@@ -144,8 +412,7 @@ def map_gpt_command(
     temporary_results = None
     results = []
     for chunk in chunks:
-        data = {"TEXT": chunk, "TEMPORARY_RESULTS": temporary_results}
-        data_str = json.dumps(data, ensure_ascii=False)
+        data_str = _get_map_step_data(chunk, temporary_results)
         temporary_results = run_command_with_gpt(command, data_str, model=model)
         results.append(temporary_results)
 
@@ -156,6 +423,38 @@ def map_gpt_command(
         return results[-1]
 
 
+def _get_map_step_data(chunk, temporary_results):
+    data = {"TEXT": chunk, "TEMPORARY_RESULTS": temporary_results}
+    return json.dumps(data, ensure_ascii=False)
+
+
+async def aiter_map_gpt_command(
+    chunks, command, model="gpt-3.5-turbo", stream_tokens=False, logger=None
+) -> AsyncIterator[str]:
+    """
+    Async version of map_gpt_command, yields results as soon as they arrive
+    stream_tokens=False - yields the result of each chunk
+    stream_tokens=True - yields the growing result of the current chunk
+    token by token, the last one for a chunk is its full result
+    """
+    if logger is None:
+        logger = loguru.logger
+    logger.debug(f"Running command: {command}")
+
+    temporary_results = None
+    for chunk in chunks:
+        data_str = _get_map_step_data(chunk, temporary_results)
+        if stream_tokens:
+            result = ""
+            async for delta in astream_command_with_gpt(command, data_str, model=model):
+                result += delta
+                yield result
+        else:
+            result = await arun_command_with_gpt(command, data_str, model=model)
+            yield result
+        temporary_results = result
+
+
 MERGE_COMMAND_TEMPLATE = """
 You're merge assistant. The following command was applied to each chunk.
 The results are separated by keyword "{keyword}"
@@ -179,6 +478,8 @@ async def amap_gpt_command(chunks, command, model="gpt-3.5-turbo", merge=False):
         merge_command = MERGE_COMMAND_TEMPLATE.format(
             command=command, keyword="TEMPORARY_RESULT:"
         ).strip()
-        return apply_command_recursively(merge_command, completed_tasks, model=model)
+        return await apply_command_recursively(
+            merge_command, completed_tasks, model=model
+        )
     else:
         return completed_tasks
@@ -1,8 +1,48 @@
+import atexit
+import json
 import os
+import queue
 import sys
+import threading
+import time
+import traceback
 
 import loguru
 import mongoengine
+from mongoengine import Q
+
+
+def _get_log_item_meta():
+    """
+    Indexes for load_logs queries - newest first, optionally filtered by
+    level, component or user
+    Retention, one of:
+    LOG_RETENTION_DAYS - TTL index, mongo removes older items
+    LOG_CAPPED_SIZE_MB - capped collection, the oldest items are overwritten
+    """
+    meta = {
+        "collection": os.getenv("LOG_MONGO_COLLECTION", "logs"),
+        "indexes": [
+            ("-timestamp", "-_id"),
+            # filter prefix + the load_logs sort order - no in-memory sort
+            ("level", "-timestamp", "-_id"),
+            ("component", "-timestamp", "-_id"),
+            ("user", "-timestamp", "-_id"),
+        ],
+    }
+    capped_size_mb = os.getenv("LOG_CAPPED_SIZE_MB")
+    retention_days = os.getenv("LOG_RETENTION_DAYS")
+    if capped_size_mb:
+        # capped collections don't support TTL indexes
+        meta["max_size"] = int(capped_size_mb) * 1024 * 1024
+    elif retention_days:
+        meta["indexes"].append(
+            {
+                "fields": ["timestamp"],
+                "expireAfterSeconds": int(float(retention_days) * 24 * 60 * 60),
+            }
+        )
+    return meta
 
 
 class LogItem(mongoengine.Document):
@@ -17,23 +57,160 @@ class LogItem(mongoengine.Document):
     user = mongoengine.StringField()
     data = mongoengine.StringField()
 
-    meta = {"collection": os.getenv("LOG_MONGO_COLLECTION", "logs")}
+    meta = _get_log_item_meta()
 
 
-def mongo_sink(message):
-    log_item = LogItem(
-        level=message.record["level"].name,
-        message=message.record["message"],
-        timestamp=message.record["time"],
-        exception=str(message.record["exception"]),
-        traceback=message.record["exception"].__traceback__
-        if message.record["exception"]
+def _make_log_document(record) -> dict:
+    render_data(record)  # no-op if the patcher is set up
+    exception = record["exception"]
+    data = record["extra"].get("data", None)
+    return {
+        "level": record["level"].name,
+        "message": record["message"],
+        "timestamp": record["time"],
+        "exception": str(exception) if exception else None,
+        "traceback": "".join(traceback.format_exception(*exception))
+        if exception
         else None,
-        component=message.record["extra"].get("component", None),
-        user=message.record["extra"].get("user", None),
-        data=message.record["extra"].get("data", None),
-    )
-    log_item.save()
+        "component": record["extra"].get("component", None),
+        "user": record["extra"].get("user", None),
+        "data": data if data is None or isinstance(data, str) else str(data),
+    }
+
+
+def mongo_sink(message):
+    """
+    Save each record right away, blocking. See MongoLogSink for the batched version
+    """
+    LogItem(**_make_log_document(message.record)).save()
+
+
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 1  # seconds
+LOG_QUEUE_SIZE = 10_000
+LOG_STOP_TIMEOUT = 5  # seconds to flush the queue on exit
+_STOP = object()
+
+
+class MongoLogSink:
+    """
+    Loguru sink that writes log items to mongo in batches from a background thread
+    Logging a line only puts it on a queue, batches are flushed with insert_many
+    when batch_size records are collected or every flush_interval seconds
+
+    When the queue is full (mongo is slow or down) new records are
+    dropped (overflow="drop") or appended to spill_path as json lines (overflow="spill")
+    The same happens to the records still queued when stop() times out
+    """
+
+    def __init__(
+        self,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        max_queue_size: int = LOG_QUEUE_SIZE,
+        overflow: str = "drop",
+        spill_path: str = None,
+        document_class=LogItem,
+    ):
+        if overflow not in ("drop", "spill"):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if overflow == "spill" and spill_path is None:
+            raise ValueError("spill_path is required for overflow='spill'")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        if overflow == "spill":
+            os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+        self.document_class = document_class
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue_size)
+        self._spill_lock = threading.Lock()
+        self._stop_deadline = None
+        self._thread = threading.Thread(
+            target=self._run, name="mongo-log-sink", daemon=True
+        )
+        self._thread.start()
+
+    def __call__(self, message):
+        document = _make_log_document(message.record)
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self._handle_overflow([document])
+
+    def _handle_overflow(self, documents):
+        if self.overflow == "drop":
+            self.dropped += len(documents)
+            return
+        with self._spill_lock, open(self.spill_path, "a") as f:
+            for document in documents:
+                f.write(json.dumps(document, default=str) + "\n")
+
+    def _is_past_stop_deadline(self):
+        return (
+            self._stop_deadline is not None and time.monotonic() > self._stop_deadline
+        )
+
+    def _run(self):
+        stopping = False
+        while not stopping and not self._is_past_stop_deadline():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    document = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if document is _STOP:
+                    stopping = True
+                    break
+                batch.append(document)
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            collection = self.document_class._get_collection()
+            collection.insert_many(batch, ordered=False)
+        except Exception as e:
+            # can't log this with loguru - it would come back here
+            sys.stderr.write(f"Failed to write {len(batch)} log items to mongo: {e}\n")
+            self._handle_overflow(batch)
+
+    def _drain_to_overflow(self):
+        documents = []
+        while True:
+            try:
+                document = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if document is not _STOP:
+                documents.append(document)
+        if documents:
+            sys.stderr.write(f"{len(documents)} log items not written to mongo\n")
+            self._handle_overflow(documents)
+
+    def stop(self, timeout: float = LOG_STOP_TIMEOUT):
+        """
+        Flush the queued records and stop the thread
+        After timeout seconds the rest is dropped or spilled, None waits for all
+        """
+        if not self._thread.is_alive():
+            return
+        if timeout is not None:
+            self._stop_deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass  # the thread stops at the deadline
+        if timeout is not None:
+            timeout = max(0.0, self._stop_deadline - time.monotonic())
+        self._thread.join(timeout)
+        self._drain_to_overflow()
 
 
 DATA_CUTOFF = 100
@@ -46,20 +223,74 @@ custom_formatter = (
     "<yellow>Data (Total length: {extra[data_length]}):</yellow> "
     "<level>{extra[truncated_data]}</level>"
 )
+default_formatter = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+
+
+def render_data(record):
+    """
+    Patcher: render data once per record, for all sinks
+    data can be a callable, so that it's only built if the record is logged:
+    logger.debug("Parsed audio", data=lambda: pprint.pformat(chunks))
+    Loguru calls patchers only for records that pass some handler's level
+    """
+    extra = record["extra"]
+    if "data" not in extra or "data_length" in extra:
+        return
+    data = extra["data"]
+    if callable(data):
+        try:
+            data = data()
+        except Exception as e:
+            data = f"<failed to render data: {e!r}>"
+    if not isinstance(data, str):
+        data = str(data)
+    extra["data"] = data
+    extra["data_length"] = len(data)
+    extra["truncated_data"] = data[:DATA_CUTOFF] + (
+        "..." if len(data) > DATA_CUTOFF else ""
+    )
+
+
+def format_record(record):
+    if "data" in record["extra"]:
+        return custom_formatter + "\n{exception}"
+    return default_formatter + "\n{exception}"
+
+
+def format_record_json(record):
+    """
+    One json object per line, with the truncated data instead of the full one
+    (loguru's serialize=True would dump the whole extra)
+    """
+    extra = record["extra"]
+    exception = record["exception"]
+    item = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "name": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "component": extra.get("component"),
+        "user": extra.get("user"),
+        "data_length": extra.get("data_length"),
+        "data": extra.get("truncated_data"),
+        "exception": "".join(traceback.format_exception(*exception))
+        if exception
+        else None,
+    }
+    extra["_json"] = json.dumps(item, default=str, ensure_ascii=False)
+    return "{extra[_json]}\n"
 
 
 def data_filter(record):
     if "data" not in record["extra"]:
         return False
-    data = record["extra"]["data"]
-    total_length = len(data)
-    truncated_data = data[:DATA_CUTOFF]
-    truncated_data += "..." if total_length > DATA_CUTOFF else ""
-
-    # Add these to the record so they can be used in the formatter
-    record["extra"]["data_length"] = total_length
-    record["extra"]["truncated_data"] = truncated_data
-
+    render_data(record)  # no-op if the patcher is set up
     return True  # Allow the log message to be processed further
 
 
@@ -68,6 +299,7 @@ def no_data_filter(record):
 
 
 logger_initialized = False
+mongo_log_sink = None
 
 
 def setup_logger(
@@ -76,6 +308,7 @@ def setup_logger(
     log_to_db: bool = None,
     file_path: str = None,
     remove_existing_handlers: bool = True,
+    serialize: bool = None,
 ):
     """
     Setup logger to
@@ -89,6 +322,7 @@ def setup_logger(
     For now, let's make this explicit:
     2) if log_to_file=True - log to file
     3) if log_to_db=True - log to db
+    serialize=True - write json lines to stderr and file instead of text
     :return:
     """
     global logger_initialized
@@ -99,13 +333,15 @@ def setup_logger(
     if remove_existing_handlers:
         logger.remove()
 
+    logger.configure(patcher=render_data)
+    if serialize is None:
+        serialize = os.getenv("LOG_SERIALIZE", False)
+    formatter = format_record_json if serialize else format_record
+
     if log_to_stderr is None:
         log_to_stderr = os.getenv("LOG_TO_STDERR", True)
     if log_to_stderr:
-        logger.add(sys.stderr, level="DEBUG", filter=no_data_filter)
-        logger.add(
-            sys.stderr, level="DEBUG", filter=data_filter, format=custom_formatter
-        )
+        logger.add(sys.stderr, level="DEBUG", format=formatter)
 
     if log_to_file is None:
         log_to_file = os.getenv("LOG_TO_FILE", False)
@@ -117,21 +353,42 @@ def setup_logger(
             rotation="1 week",
             # retention="10 days",
             level="DEBUG",
+            **({"format": format_record_json} if serialize else {}),
         )
 
     if log_to_db is None:
         log_to_db = os.getenv("LOG_TO_DB", False)
     if log_to_db:
-        logger.add(mongo_sink, level="INFO")
+        global mongo_log_sink
+        mongo_log_sink = MongoLogSink(
+            overflow=os.getenv("LOG_DB_OVERFLOW", "drop"),
+            spill_path=os.getenv("LOG_DB_SPILL_PATH", "logs/log_spill.jsonl"),
+        )
+        atexit.register(mongo_log_sink.stop)
+        logger.add(mongo_log_sink, level="INFO")
 
     # return logger
     logger_initialized = True
 
 
-def load_logs(limit=100, **filters):
-    result = LogItem.objects
-    result = result.filter(**filters)
-    return result.order_by("-timestamp").limit(limit).as_pymongo()
+def load_logs(limit=100, cursor: dict = None, fields=None, **filters):
+    """
+    Load the newest logs matching the filters, as dicts
+    cursor - the last item of the previous page, to load the next one:
+        page = load_logs(level="ERROR")
+        next_page = load_logs(level="ERROR", cursor=page[-1])
+    fields - return only these fields (timestamp and _id are always included)
+    """
+    result = LogItem.objects.filter(**filters)
+    if cursor is not None:
+        # skip-free pagination - (timestamp, _id) is unique and indexed
+        timestamp, item_id = cursor["timestamp"], cursor["_id"]
+        result = result.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=item_id)
+        )
+    if fields is not None:
+        result = result.only("timestamp", *fields)
+    return list(result.order_by("-timestamp", "-id").limit(limit).as_pymongo())
 
 
 # Test the logger
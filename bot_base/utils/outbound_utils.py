@@ -0,0 +1,283 @@
+"""
+Outbound message queue that keeps the bot within telegram's flood limits
+
+- ~30 messages per second globally
+- ~1 message per second per chat, ~20 per minute per group
+
+outbound = OutboundQueue()
+await outbound.send(chat_id, bot.send_message, chat_id, text)
+async with outbound.ordered(chat_id):  # multi-message reply, not interleaved
+    for chunk in chunks:
+        await outbound.send(chat_id, bot.send_message, chat_id, chunk)
+
+TextInputFile uploads long texts as files without encoding them whole
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Optional,
+    Union,
+)
+
+import loguru
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE, InputFile
+
+GLOBAL_RATE = 30  # messages per second
+CHAT_RATE = 1  # messages per second
+GROUP_RATE = 20 / 60  # messages per second
+CHAT_BURST = 3
+MAX_RETRIES = 3
+IDLE_SWEEP_INTERVAL = 60  # seconds, how often state of idle chats is dropped
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # replies to users
+    BULK = 1  # broadcasts, notifications
+
+
+class RateLimiter:
+    """
+    Token bucket, waiters with a lower priority value are served first
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._releaser: Optional[asyncio.Task] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - max(self._updated_at, self._paused_until)
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def _delay(self) -> float:
+        """
+        Seconds until a token is available
+        """
+        self._refill()
+        paused = self._paused_until - time.monotonic()
+        if paused > 0:
+            return paused
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self, priority: int = Priority.INTERACTIVE):
+        if not self._waiters and self._delay() == 0:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._releaser is None or self._releaser.done():
+            self._releaser = asyncio.create_task(self._release())
+        await future
+
+    async def _release(self):
+        while self._waiters:
+            delay = self._delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # cancelled while waiting
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+
+    def is_idle(self) -> bool:
+        """
+        Nobody waits and the bucket is full - same as a new limiter
+        """
+        if self._waiters or self._paused_until > time.monotonic():
+            return False
+        self._refill()
+        return self._tokens >= self.burst
+
+    def pause(self, seconds: float):
+        """
+        No tokens until the pause is over, e.g. after a RetryAfter
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _ChatLock:
+    """
+    Reentrant lock, so that send() works inside ordered() of the same task
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner: Optional[asyncio.Task] = None
+        self._depth = 0
+        self._users = 0  # holding or waiting
+
+    def is_idle(self) -> bool:
+        return self._users == 0
+
+    @asynccontextmanager
+    async def hold(self):
+        self._users += 1
+        try:
+            task = asyncio.current_task()
+            if self._owner is not task:
+                await self._lock.acquire()
+                self._owner = task
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._owner = None
+                    self._lock.release()
+        finally:
+            self._users -= 1
+
+
+class OutboundQueue:
+    """
+    Deliver bot API calls within the global and per-chat rate limits
+
+    - interactive calls go ahead of bulk ones waiting for the global limit
+    - calls to one chat are delivered in order, ordered() groups several
+    - RetryAfter pauses the chat for the time telegram asked and retries
+    - state of chats that went idle is dropped, so it doesn't grow with
+      every chat the bot ever wrote to
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        group_rate: float = GROUP_RATE,
+        chat_burst: int = CHAT_BURST,
+        max_retries: int = MAX_RETRIES,
+        logger=None,
+    ):
+        self.global_limiter = RateLimiter(global_rate, burst=global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        if logger is None:
+            logger = loguru.logger
+        self.logger = logger
+        self._chat_limiters: Dict[Hashable, RateLimiter] = {}
+        self._chat_locks: Dict[Hashable, _ChatLock] = defaultdict(_ChatLock)
+        self._swept_at = time.monotonic()
+
+    def _get_chat_limiter(self, chat_id) -> RateLimiter:
+        if chat_id not in self._chat_limiters:
+            # group and channel ids are negative
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            self._chat_limiters[chat_id] = RateLimiter(rate, burst=self.chat_burst)
+        return self._chat_limiters[chat_id]
+
+    def _sweep_idle_chats(self):
+        self._swept_at = time.monotonic()
+        for chat_id in list(self._chat_limiters):
+            lock = self._chat_locks.get(chat_id)
+            if self._chat_limiters[chat_id].is_idle() and (
+                lock is None or lock.is_idle()
+            ):
+                del self._chat_limiters[chat_id]
+        for chat_id in list(self._chat_locks):
+            if self._chat_locks[chat_id].is_idle():
+                del self._chat_locks[chat_id]
+
+    def ordered(self, chat_id):
+        """
+        Hold the chat for a multi-message reply:
+        async with outbound.ordered(chat_id): ...
+        """
+        return self._chat_locks[chat_id].hold()
+
+    async def send(
+        self,
+        chat_id,
+        func: Callable[..., Awaitable],
+        /,
+        *args,
+        priority: int = Priority.INTERACTIVE,
+        **kwargs,
+    ) -> Any:
+        if time.monotonic() - self._swept_at > IDLE_SWEEP_INTERVAL:
+            self._sweep_idle_chats()
+        chat_limiter = self._get_chat_limiter(chat_id)
+        async with self.ordered(chat_id):
+            for attempt in range(self.max_retries + 1):
+                await chat_limiter.acquire(priority)
+                await self.global_limiter.acquire(priority)
+                try:
+                    return await func(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.logger.warning(
+                        f"Flood control in chat {chat_id}, "
+                        f"retrying in {e.retry_after}s"
+                    )
+                    chat_limiter.pause(e.retry_after)
+
+
+class TextInputFile(InputFile):
+    """
+    Upload text as a file, encoding it chunk by chunk while it's being sent
+    Only one encoded chunk is held in memory at a time, unlike
+    BufferedInputFile(text.encode(), ...)
+
+    text - a string or an iterable of strings (the latter can be read only once)
+    """
+
+    def __init__(
+        self,
+        text: Union[str, Iterable[str]],
+        filename: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        encoding: str = "utf-8",
+    ):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.text = text
+        self.encoding = encoding
+
+    def _iter_parts(self):
+        if isinstance(self.text, str):
+            # a utf-8 char is up to 4 bytes
+            step = max(self.chunk_size // 4, 1)
+            for start in range(0, len(self.text), step):
+                yield self.text[start : start + step]
+        else:
+            yield from self.text
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        buffer = bytearray()
+        for part in self._iter_parts():
+            buffer += part.encode(self.encoding)
+            if len(buffer) >= self.chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
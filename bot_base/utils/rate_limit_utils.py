@@ -0,0 +1,189 @@
+"""
+Rate limits for OpenAI calls, metered per model in requests and in units:
+tokens for chat models, seconds of audio for whisper
+
+limiter = rate_limiters.get("gpt-4")
+await limiter.acquire(units=prompt_tokens)
+result = await call_with_rate_limit(limiter, func, *args, units=prompt_tokens)
+
+The registry is process-wide, so several App instances share the same budget
+"""
+import asyncio
+import random
+import re
+import time
+from typing import Dict, NamedTuple, Optional
+
+import loguru
+import openai
+from aiolimiter import AsyncLimiter
+
+
+class ModelLimits(NamedTuple):
+    requests_per_minute: int
+    units_per_minute: Optional[int] = None  # tokens or audio seconds
+
+
+# conservative request budgets, raise with rate_limiters.configure()
+# for higher account tiers
+DEFAULT_LIMITS = {
+    "gpt-3.5-turbo": ModelLimits(200, 90_000),
+    "gpt-3.5-turbo-16k": ModelLimits(200, 180_000),
+    "gpt-4": ModelLimits(200, 40_000),
+    "whisper-1": ModelLimits(50, 50 * 60 * 10),  # ~50 ten-minute files
+}
+FALLBACK_LIMITS = ModelLimits(200)
+
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1  # seconds, doubled on each retry
+RETRY_MAX_DELAY = 60
+
+
+class ModelRateLimiter:
+    """
+    Meter requests and units (tokens / audio seconds) of one model together
+    A 429 pauses all callers until the provider's reset time
+    """
+
+    def __init__(self, limits: ModelLimits, period: float = 60):
+        self.limits = limits
+        self.requests = AsyncLimiter(limits.requests_per_minute, period)
+        self.units = None
+        if limits.units_per_minute:
+            self.units = AsyncLimiter(limits.units_per_minute, period)
+        self._paused_until = 0.0
+
+    async def acquire(self, units: float = 0):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        await self.requests.acquire()
+        if self.units is not None and units > 0:
+            # aiolimiter refuses amounts above the bucket size
+            await self.units.acquire(min(units, self.units.max_rate))
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+
+class RateLimiterRegistry:
+    """
+    One ModelRateLimiter per model, created on first use
+    """
+
+    def __init__(self, limits: Dict[str, ModelLimits] = None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._limiters: Dict[str, ModelRateLimiter] = {}
+
+    def get(self, model: str) -> ModelRateLimiter:
+        if model not in self._limiters:
+            limits = self.limits.get(model, FALLBACK_LIMITS)
+            self._limiters[model] = ModelRateLimiter(limits)
+        return self._limiters[model]
+
+    def configure(self, model: str, limits: ModelLimits):
+        """
+        Set the limits of a model, e.g. for a different account tier
+        """
+        self.limits[model] = limits
+        self._limiters.pop(model, None)
+
+
+# shared by everything in the process
+rate_limiters = RateLimiterRegistry()
+
+_duration_re = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value: str) -> Optional[float]:
+    """
+    Parse reset headers like "1s", "6m0s", "20ms" into seconds
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _duration_re.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _duration_units[unit] for amount, unit in parts)
+
+
+def get_retry_after(error: openai.error.OpenAIError) -> Optional[float]:
+    """
+    Seconds to wait according to the rate limit error headers, if any
+    """
+    headers = error.headers or {}
+    headers = {key.lower(): value for key, value in headers.items()}
+    delays = [
+        parse_reset_duration(headers.get(header))
+        for header in (
+            "retry-after",
+            "x-ratelimit-reset-requests",
+            "x-ratelimit-reset-tokens",
+        )
+    ]
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
+
+
+def get_backoff_delay(attempt: int, retry_after: float = None) -> float:
+    if retry_after is not None:
+        delay = retry_after
+    else:
+        delay = min(RETRY_BASE_DELAY * 2**attempt, RETRY_MAX_DELAY)
+    # jitter, so that the callers paused together don't retry together
+    return delay * random.uniform(1, 1.5)
+
+
+def _get_file_positions(args, kwargs):
+    """
+    Positions of the file-like arguments, to rewind them before a retry
+    """
+    return [
+        (value, value.tell())
+        for value in [*args, *kwargs.values()]
+        if hasattr(value, "seek") and hasattr(value, "tell")
+    ]
+
+
+async def call_with_rate_limit(
+    limiter: ModelRateLimiter,
+    func,
+    *args,
+    units: float = 0,
+    max_retries: int = MAX_RETRIES,
+    logger=None,
+    **kwargs,
+):
+    """
+    Reserve capacity with the limiter and call func, retry on 429
+    File-like arguments are rewound before each retry - the failed attempt
+    has already read them
+    """
+    if logger is None:
+        logger = loguru.logger
+    file_positions = _get_file_positions(args, kwargs)
+    for attempt in range(max_retries + 1):
+        for file, position in file_positions:
+            file.seek(position)
+        await limiter.acquire(units)
+        try:
+            return await func(*args, **kwargs)
+        except openai.error.RateLimitError as e:
+            if attempt == max_retries:
+                raise
+            retry_after = get_retry_after(e)
+            delay = get_backoff_delay(attempt, retry_after)
+            if retry_after is not None:
+                limiter.pause(delay)
+            logger.warning(f"Rate limited, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
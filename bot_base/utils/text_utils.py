@@ -1,22 +1,122 @@
 import re
+from typing import Iterator, Optional
+
+from bot_base.utils.cache_utils import LRUCache, hash_text
 
 MAX_TELEGRAM_MESSAGE_LENGTH = 4096
 
 
 def split_long_message(text, max_length=MAX_TELEGRAM_MESSAGE_LENGTH, sep="\n"):
-    chunks = []
-    while len(text) > max_length:
-        chunk = text[:max_length]
-        if sep:
-            # split the text on the last sep character, if it exists
-            last_sep = chunk.rfind(sep)
-            if last_sep != -1:
-                chunk = chunk[: last_sep + 1]
-        text = text[len(chunk) :]
-        chunks.append(chunk)
-    if text:
-        chunks.append(text)  # add the remaining text as the last chunk
-    return chunks
+    return list(iter_split_long_message(text, max_length=max_length, sep=sep))
+
+
+FENCE = "```"
+MAX_FENCE_LINE_LENGTH = 64
+MIN_FENCE_CONTENT = 2  # an escape sequence
+# a reopened block: "```\n" + content + "\n```"
+MIN_FENCED_MESSAGE_LENGTH = 2 * (len(FENCE) + 1) + MIN_FENCE_CONTENT
+
+
+def _find_cut(text, start, end, sep):
+    """
+    Last good split point in text[start:end]
+    """
+    cut = end
+    if sep:
+        last_sep = text.rfind(sep, start, end)
+        if last_sep != -1:
+            cut = last_sep + len(sep)
+    if cut < len(text):
+        # don't split an escape sequence: odd run of backslashes before the cut
+        i = cut - 1
+        while i >= start and text[i] == "\\":
+            i -= 1
+        if (cut - 1 - i) % 2 == 1:
+            cut -= 1
+        # don't split a fence
+        while cut - 1 > start and text[cut - 1] == "`" and text[cut] == "`":
+            cut -= 1
+    if cut <= start:
+        # no good split point - hard cut, always making progress
+        cut = max(end, start + 1)
+    return cut
+
+
+def _get_fence_line(text, fence_start, cut, max_length=MAX_FENCE_LINE_LENGTH):
+    line_end = text.find("\n", fence_start, cut)
+    if line_end == -1 or line_end + 1 - fence_start > max_length:
+        return FENCE + "\n"
+    return text[fence_start : line_end + 1]
+
+
+def _find_fences(text, start, end):
+    # str.find is much faster than a regex with a lookbehind here
+    fences = []
+    i = text.find(FENCE, start, end)
+    while i != -1:
+        if i == 0 or text[i - 1] != "\\":  # an escaped backtick is not a fence
+            fences.append(i)
+        i = text.find(FENCE, i + len(FENCE), end)
+    return fences
+
+
+def iter_split_long_message(
+    text, max_length=MAX_TELEGRAM_MESSAGE_LENGTH, sep="\n"
+) -> Iterator[str]:
+    """
+    Split text into messages of at most max_length, in one pass and lazily
+    Prefers splitting on sep, never splits an escape sequence of escape_md.
+    A ``` block is moved to the next message whole if possible, otherwise
+    it's closed at the end of the message and reopened in the next one
+    """
+    if max_length < 1:
+        raise ValueError(f"max_length must be positive, got {max_length}")
+    if max_length < MIN_FENCED_MESSAGE_LENGTH and FENCE in text:
+        raise ValueError(
+            f"max_length {max_length} is too small to split code blocks, "
+            f"at least {MIN_FENCED_MESSAGE_LENGTH} is required"
+        )
+    # the reopened fence line leaves room for the content and the closing fence
+    max_fence_line = min(
+        MAX_FENCE_LINE_LENGTH + 1,
+        max_length - len(FENCE) - 1 - MIN_FENCE_CONTENT,
+    )
+    pos = 0
+    reopen = ""  # fence line of a block continued from the previous message
+    while len(text) - pos + len(reopen) > max_length:
+        budget = max_length - len(reopen)
+        cut = _find_cut(text, pos, pos + budget, sep)
+        fences = _find_fences(text, pos, cut)
+        is_open = bool(reopen) != (len(fences) % 2 == 1)
+        if not is_open:
+            yield reopen + text[pos:cut]
+            pos, reopen = cut, ""
+            continue
+
+        if fences:
+            # the block starts in this message - try moving it to the next one
+            line_start = max(text.rfind("\n", pos, fences[-1]) + 1, pos)
+            if line_start > pos:
+                yield reopen + text[pos:line_start]
+                pos, reopen = line_start, ""
+                continue
+
+        # the block doesn't fit in a message - close it and reopen in the next
+        cut = _find_cut(text, pos, pos + budget - len(FENCE) - 1, sep)
+        fences = _find_fences(text, pos, cut)
+        chunk = reopen + text[pos:cut]
+        if bool(reopen) != (len(fences) % 2 == 1):
+            if fences:
+                reopen = _get_fence_line(text, fences[-1], cut, max_fence_line)
+            if not chunk.endswith("\n"):
+                chunk += "\n"
+            chunk += FENCE
+        else:
+            reopen = ""
+        yield chunk
+        pos = cut
+    if pos < len(text):
+        yield reopen + text[pos:]
 
 
 SPECIAL_CHARS = r"\\_\*\[\]\(\)~`><&#+\-=\|\{\}\.\!"
@@ -28,3 +128,233 @@ escape_re = re.compile(f"[{SPECIAL_CHARS}]")
 def escape_md(text: str) -> str:
     """Escape markdown special characters in the text."""
     return escape_re.sub(r"\\\g<0>", text)
+
+
+# ------------------ MarkdownV2 validation ------------------ #
+
+# characters telegram rejects in MarkdownV2 unless escaped or part of markup
+MARKDOWN_V2_SPECIAL = "_*[]()~`>#+-=|{}.!"
+markdown_v2_re = re.compile(r"[\\_*\[\]()~`>#+\-=|{}.!]")
+# only the markup characters and line breaks affect the validity of the text
+_skeleton_re = re.compile(r"[^\\_*\[\]()~`>#+\-=|{}.!\n]+")
+MAX_MARKDOWN_REPAIRS = 50
+MARKDOWN_MEMO_SIZE = 4096
+
+
+def _find_closing(text, start, closing):
+    """
+    Position after the closing marker, skipping escaped characters
+    """
+    i = start
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+        elif text.startswith(closing, i):
+            return i + len(closing)
+        else:
+            i += 1
+    return None
+
+
+def find_markdown_v2_error(text: str) -> Optional[int]:
+    """
+    Position of the first character telegram would fail to parse in MarkdownV2
+    None if the text is valid
+    """
+    stack = []  # (marker, position) of open entities
+    i = 0
+    while (match := markdown_v2_re.search(text, i)) is not None:
+        i = match.start()
+        c = text[i]
+        if c == "\\":
+            if i + 1 == len(text):
+                return i
+            i += 2
+            continue
+        if c == "`":
+            fence = "```" if text.startswith("```", i) else "`"
+            end = _find_closing(text, i + len(fence), fence)
+            if end is None:
+                return i
+            i = end
+            continue
+
+        if text.startswith("__", i) or text.startswith("||", i):
+            marker = text[i : i + 2]
+        elif c in "*_~":
+            marker = c
+        else:
+            marker = None
+        if marker is not None:
+            if stack and stack[-1][0] == marker:
+                stack.pop()
+            elif any(open_marker == marker for open_marker, _ in stack):
+                return i  # entities overlap instead of nesting
+            else:
+                stack.append((marker, i))
+            i += len(marker)
+            continue
+
+        if c == "[":
+            stack.append((c, i))
+        elif c == "]":
+            if not stack or stack[-1][0] != "[" or not text.startswith("(", i + 1):
+                return i
+            stack.pop()
+            end = _find_closing(text, i + 2, ")")
+            if end is None:
+                return i + 1
+            i = end
+            continue
+        elif c == ">" and (i == 0 or text[i - 1] == "\n"):
+            pass  # quote
+        elif c == "!" and text.startswith("![", i):
+            pass  # custom emoji
+        else:
+            return i
+        i += 1
+    if stack:
+        return stack[-1][1]
+    return None
+
+
+def repair_markdown_v2(text: str, max_repairs=MAX_MARKDOWN_REPAIRS) -> Optional[str]:
+    """
+    Escape the characters telegram would fail to parse
+    None if the text is too broken to repair
+    """
+    for _ in range(max_repairs):
+        position = find_markdown_v2_error(text)
+        if position is None:
+            return text
+        text = text[:position] + "\\" + text[position:]
+    return None
+
+
+_VALID, _REPAIR, _PLAIN = "valid", "repair", "plain"
+# text skeleton -> outcome
+_markdown_v2_memo = LRUCache(max_size=MARKDOWN_MEMO_SIZE)
+
+
+def _get_markdown_v2_key(text: str) -> str:
+    # texts from one template differ in words, not in markup
+    return hash_text(_skeleton_re.sub("a", text))
+
+
+def prepare_markdown_v2(text: str) -> Optional[str]:
+    """
+    Text to send with MarkdownV2 - as is or repaired
+    None if it should be sent as plain text
+    Outcomes are memoized per template (the text with words stripped)
+    """
+    key = _get_markdown_v2_key(text)
+    outcome = _markdown_v2_memo.get(key)
+    if outcome == _VALID:
+        return text
+    if outcome == _PLAIN:
+        return None
+    repaired = repair_markdown_v2(text)
+    if outcome is None:
+        if repaired is None:
+            outcome = _PLAIN
+        else:
+            outcome = _VALID if repaired == text else _REPAIR
+        _markdown_v2_memo.set(key, outcome)
+    return repaired
+
+
+def reject_markdown_v2(text: str):
+    """
+    Telegram failed to parse the text anyway - send its template as plain text
+    """
+    _markdown_v2_memo.set(_get_markdown_v2_key(text), _PLAIN)
+
+
+# ------------------ Transcript stitching ------------------ #
+
+# 5s of audio overlap is ~15 words, leave a margin for whisper's variations
+STITCH_WINDOW = 32  # words
+STITCH_MIN_OVERLAP = 4  # words
+# whisper garbles the words cut at the chunk edges - the common run may stop
+# a few words before the end of the left chunk / start after the right one's
+STITCH_EDGE_SLACK = 3  # words
+
+word_re = re.compile(r"\S+")
+_normalize_re = re.compile(r"[^\w]+")
+
+
+def _normalize_word(word: str) -> str:
+    return _normalize_re.sub("", word.lower())
+
+
+def _find_seam(
+    left: str,
+    right: str,
+    window=STITCH_WINDOW,
+    min_overlap=STITCH_MIN_OVERLAP,
+    edge_slack=STITCH_EDGE_SLACK,
+):
+    """
+    Align the tail of `left` with the head of `right`
+    Return (left_end, right_start) char positions of the seam, or None
+    The common run has to reach the end of `left` and start at the beginning
+    of `right` (up to edge_slack words) - a phrase that merely occurs in both
+    chunks is not an overlap
+    Only `window` words on each side are compared, so the cost doesn't
+    depend on the chunk length
+    """
+    # the tail: last `window` words of the left chunk
+    tail = list(word_re.finditer(left, max(0, len(left) - window * 64)))[-window:]
+    head = []
+    for match in word_re.finditer(right):
+        head.append(match)
+        if len(head) == window:
+            break
+
+    a = [_normalize_word(m.group()) for m in tail]
+    b = [_normalize_word(m.group()) for m in head]
+    best = None  # (size, i, j)
+    for j in range(min(edge_slack + 1, len(b))):
+        for i in range(len(a)):
+            size = 0
+            while (
+                i + size < len(a) and j + size < len(b) and a[i + size] == b[j + size]
+            ):
+                size += 1
+            if i + size < len(a) - edge_slack:
+                continue  # the run stops before the end of the left chunk
+            if size >= min_overlap and (best is None or size > best[0]):
+                best = (size, i, j)
+    if best is None:
+        return None
+    size, i, j = best
+    # keep the left chunk up to the end of the common run
+    # and continue the right chunk right after it
+    left_end = tail[i + size - 1].end()
+    right_start = head[j + size - 1].end()
+    return left_end, right_start
+
+
+def stitch_transcripts(
+    chunks, window=STITCH_WINDOW, min_overlap=STITCH_MIN_OVERLAP, sep="\n\n"
+) -> str:
+    """
+    Join transcripts of overlapping audio chunks, removing the duplicated words
+    Chunks that don't overlap are joined with `sep`
+    """
+    chunks = [chunk for chunk in chunks if chunk]
+    if not chunks:
+        return ""
+    parts = []
+    current = chunks[0]
+    for chunk in chunks[1:]:
+        seam = _find_seam(current, chunk, window=window, min_overlap=min_overlap)
+        if seam is None:
+            parts.extend([current, sep])
+            current = chunk
+        else:
+            left_end, right_start = seam
+            parts.append(current[:left_end])
+            current = chunk[right_start:]
+    parts.append(current)
+    return "".join(parts)
@@ -0,0 +1,110 @@
+"""
+aiohttp server that receives telegram updates over a webhook
+
+server = WebhookServer(dispatcher, bot, secret_token="...")
+app = server.make_app()  # serve with aiohttp, e.g. web.AppRunner
+"""
+import asyncio
+import hmac
+from typing import Optional, Set
+
+import aiogram
+import loguru
+from aiogram import types
+from aiohttp import web
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DEFAULT_PATH = "/webhook"
+MAX_CONCURRENT_UPDATES = 100
+DRAIN_TIMEOUT = 30  # seconds
+
+
+class WebhookServer:
+    """
+    Feed updates posted by telegram to the dispatcher
+
+    - requests without the secret token are rejected
+    - updates are acknowledged right away and handled in the background,
+      at most max_concurrent_updates at once. When all slots are busy new
+      updates get 429 and telegram redelivers them later - a request is never
+      held until telegram times out and sends the same update again
+    - on shutdown new updates are refused and the running ones are given
+      drain_timeout seconds to finish
+    """
+
+    def __init__(
+        self,
+        dispatcher: aiogram.Dispatcher,
+        bot: aiogram.Bot,
+        path: str = DEFAULT_PATH,
+        secret_token: Optional[str] = None,
+        max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+        drain_timeout: float = DRAIN_TIMEOUT,
+        logger=None,
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        if logger is None:
+            logger = loguru.logger
+        self.logger = logger
+        self.max_concurrent_updates = max_concurrent_updates
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    def _check_secret_token(self, request: web.Request) -> bool:
+        if not self.secret_token:
+            return True
+        token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        return hmac.compare_digest(token, self.secret_token)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._check_secret_token(request):
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+            update = types.Update.model_validate(data, context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        if len(self._tasks) >= self.max_concurrent_updates:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        # acknowledge right away, telegram doesn't need to wait for the handler
+        task = asyncio.create_task(self._process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process_update(self, update: types.Update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception:
+            self.logger.exception(f"Failed to process update {update.update_id}")
+
+    async def drain(self):
+        """
+        Refuse new updates and wait for the running ones
+        """
+        self._closing = True
+        if not self._tasks:
+            return
+        self.logger.info(f"Draining {len(self._tasks)} updates")
+        _, pending = await asyncio.wait(self._tasks, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.logger.warning(f"Cancelled {len(pending)} unfinished updates")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _on_shutdown(self, app: web.Application):
+        await self.drain()
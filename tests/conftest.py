@@ -0,0 +1,12 @@
+import mongoengine
+import pytest
+
+
+@pytest.fixture
+def mongo_db():
+    import mongomock
+
+    mongoengine.disconnect()
+    mongoengine.connect("test_db", mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
@@ -1,6 +1,7 @@
 import pytest
+from pydantic import ValidationError
 
-from bot_base.core.app_config import AppConfig
+from bot_base.core.app_config import AppConfig, TelegramBotConfig
 
 
 @pytest.fixture
@@ -27,6 +28,20 @@ def test_telegram_bot_config_default(app_config):
     assert app_config.telegram_bot.dev_message_timeout == 5 * 60
     assert app_config.telegram_bot.parse_mode is None
     assert app_config.telegram_bot.send_preview_for_long_messages is False
+    assert app_config.telegram_bot.download_large_files_in_process is True
+    assert app_config.telegram_bot.max_concurrent_downloads == 4
+    assert app_config.telegram_bot.progressive_edit_interval == 1.5
+    assert app_config.telegram_bot.outbound_global_rate == 30
+    assert app_config.telegram_bot.run_mode == "polling"
+
+
+def test_run_mode_validation():
+    with pytest.raises(ValidationError):
+        TelegramBotConfig(run_mode="webhooks")
+    with pytest.raises(ValidationError):
+        TelegramBotConfig(run_mode="webhook")
+    config = TelegramBotConfig(run_mode="webhook", webhook_url="https://example.com")
+    assert config.run_mode == "webhook"
 
 
 def test_enable_openai_api_default(app_config):
@@ -37,6 +52,14 @@ def test_enable_openai_api_default(app_config):
 def test_enable_voice_recognition_default(app_config):
     assert app_config.enable_voice_recognition is False
     assert app_config.process_audio_in_parallel is False
+    assert app_config.split_audio_streaming is False
+    assert app_config.transcribe_audio_pipelined is True
+    assert app_config.transcription_cache_persistent is False
+
+
+def test_completion_cache_default(app_config):
+    assert app_config.completion_cache_size == 4096
+    assert app_config.completion_cache_persistent is False
 
 
 def test_enable_scheduler_default(app_config):
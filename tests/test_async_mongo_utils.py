@@ -0,0 +1,58 @@
+import asyncio
+
+import mongoengine
+import pytest
+
+from bot_base.data_model import async_mongo_utils
+
+
+class SampleItem(mongoengine.Document):
+    name = mongoengine.StringField(required=True)
+    url = mongoengine.StringField(db_field="u")
+    count = mongoengine.IntField(default=0)
+    meta = {"collection": "sample_items"}
+
+
+def run(coro):
+    # asyncio.run would unset the current loop, which other tests rely on
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_crud(mongo_db):
+    async def main():
+        item = await async_mongo_utils.add_item(SampleItem, name="item1", url="url1")
+        await async_mongo_utils.add_item(SampleItem, name="item2", url="url2")
+        assert (await async_mongo_utils.get_item(SampleItem, "item1")).url == "url1"
+        assert (await async_mongo_utils.get_item(SampleItem, str(item.id))).name == (
+            "item1"
+        )
+
+        await async_mongo_utils.update_item(
+            SampleItem, "item1", url="new_url1", inc__count=2
+        )
+        item = await async_mongo_utils.get_item(SampleItem, item.id)
+        assert (item.url, item.count) == ("new_url1", 2)
+        # the same documents as the sync api sees
+        assert SampleItem.objects(url="new_url1").count() == 1
+
+        items = await async_mongo_utils.list_items(SampleItem, url="url2")
+        assert [item.name for item in items] == ["item2"]
+
+        assert await async_mongo_utils.delete_item(SampleItem, "item2") == 1
+        assert await async_mongo_utils.get_item(SampleItem, "item2") is None
+        assert len(await async_mongo_utils.list_items(SampleItem)) == 1
+
+    run(main())
+
+
+def test_add_item_validates(mongo_db):
+    with pytest.raises(mongoengine.ValidationError):
+        run(async_mongo_utils.add_item(SampleItem, url="no name"))
+
+
+if __name__ == "__main__":
+    pytest.main()
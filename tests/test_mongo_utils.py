@@ -0,0 +1,67 @@
+import mongoengine
+import pytest
+
+from bot_base.data_model import mongo_utils
+
+
+class QueueItem(mongoengine.Document):
+    name = mongoengine.StringField(required=True)
+    url = mongoengine.StringField(db_field="u")
+    count = mongoengine.IntField(default=0)
+    meta = {"collection": "queue_items"}
+
+
+@pytest.fixture
+def queue(mongo_db):
+    mongo_utils._name_indexed.discard(QueueItem)
+    yield
+
+
+def test_get_update_delete_by_key(queue):
+    item = mongo_utils.add_item(QueueItem, name="item1", url="url1")
+    assert mongo_utils.get_item(QueueItem, str(item.id)).name == "item1"
+    assert mongo_utils.get_item(QueueItem, "item1").url == "url1"
+    assert "name_1" in QueueItem._get_collection().index_information()
+
+    assert mongo_utils.update_item(QueueItem, "item1", inc__count=2) == 1
+    assert mongo_utils.update_item(QueueItem, "missing", inc__count=2) == 0
+    assert mongo_utils.get_item(QueueItem, item.id).count == 2
+
+    assert mongo_utils.delete_item(QueueItem, str(item.id)) == 1
+    assert mongo_utils.get_item(QueueItem, "item1") is None
+    assert mongo_utils.delete_item(QueueItem, "item1") == 0
+
+
+def test_bulk_operations(queue):
+    items = mongo_utils.add_items(
+        QueueItem, [{"name": f"item{i}", "url": f"url{i}"} for i in range(3)]
+    )
+    assert all(item.id is not None for item in items)
+    assert QueueItem.objects.count() == 3
+
+    mongo_utils.update_items(
+        QueueItem, {"item0": {"url": "new_url0"}, str(items[1].id): {"inc__count": 1}}
+    )
+    assert QueueItem.objects(name="item0").first().url == "new_url0"
+    assert QueueItem.objects(name="item1").first().count == 1
+
+    mongo_utils.upsert_items(
+        QueueItem, [{"name": "item2", "url": "new_url2"}, {"name": "item3"}]
+    )
+    assert QueueItem.objects.count() == 4
+    assert QueueItem.objects(name="item2").first().url == "new_url2"
+    assert QueueItem.objects(name="item1").first().count == 1
+    mongo_utils.upsert_items(QueueItem, [{"name": "item1", "url": "new_url1"}])
+    assert QueueItem.objects(name="item1").first().count == 1  # not reset
+    assert QueueItem.objects(name="item3").first().count == 0
+
+    with pytest.raises(mongoengine.ValidationError):
+        mongo_utils.add_items(QueueItem, [{"url": "no name"}])
+
+    assert mongo_utils.add_items(QueueItem, []) == []
+    assert mongo_utils.update_items(QueueItem, {}) is None
+    assert mongo_utils.upsert_items(QueueItem, []) is None
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,154 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bot_base.core import sharding
+from bot_base.core.sharding import (
+    ChatOrderedRunner,
+    ShardSupervisor,
+    get_update_chat_id,
+    shard_for_update,
+)
+
+
+def make_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "text": "hi",
+        },
+    }
+
+
+def test_get_update_chat_id():
+    assert get_update_chat_id(make_update(1, 42)) == 42
+    callback = {
+        "update_id": 2,
+        "callback_query": {"id": "1", "from": {"id": 7}, "data": "x"},
+    }
+    assert get_update_chat_id(callback) == 7
+    assert get_update_chat_id({"update_id": 3}) is None
+
+
+def test_shard_for_update_is_stable_per_chat():
+    shards = {shard_for_update(make_update(i, 42), 4) for i in range(100)}
+    assert len(shards) == 1
+    spread = {shard_for_update(make_update(0, chat_id), 4) for chat_id in range(100)}
+    assert spread == {0, 1, 2, 3}
+    assert shard_for_update({"update_id": 5}, 4) == 1
+
+
+def test_chat_ordered_runner_keeps_chat_order():
+    handled = []
+
+    async def handle(chat_id, i):
+        await asyncio.sleep(0.01 * (3 - i))  # later updates are faster
+        handled.append((chat_id, i))
+
+    async def main():
+        runner = ChatOrderedRunner(max_concurrent=10)
+        for i in range(3):
+            for chat_id in ("a", "b"):
+                await runner.submit(chat_id, handle, chat_id, i)
+        await runner.join()
+
+    asyncio.run(main())
+    for chat_id in ("a", "b"):
+        assert [i for c, i in handled if c == chat_id] == [0, 1, 2]
+
+
+def test_chat_ordered_runner_burst_does_not_block_other_chats():
+    handled = []
+
+    async def handle(chat_id, i):
+        await asyncio.sleep(0.01)
+        handled.append((chat_id, i))
+
+    async def main():
+        runner = ChatOrderedRunner(max_concurrent=2)
+        for i in range(10):
+            await runner.submit("a", handle, "a", i)
+        await runner.submit("b", handle, "b", 0)
+        await runner.join()
+
+    asyncio.run(main())
+    # b runs alongside the first jobs of a, not after all of them
+    assert handled.index(("b", 0)) < 3
+
+
+def test_supervisor_poll_retries_on_errors(monkeypatch):
+    monkeypatch.setattr(sharding, "POLL_RETRY_DELAY", 0)
+    responses = [
+        ConnectionError("network is down"),
+        RuntimeError("Telegram server says - Bad Gateway"),
+        [SimpleNamespace(update_id=1, model_dump=lambda **kw: make_update(1, 42))],
+        asyncio.CancelledError(),
+    ]
+
+    async def get_updates(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    app = SimpleNamespace(
+        logger=sharding.loguru.logger,
+        bot=SimpleNamespace(
+            _aiogram_bot=SimpleNamespace(get_updates=get_updates),
+            _dp=SimpleNamespace(resolve_used_update_types=lambda: []),
+        ),
+        config=None,
+    )
+    supervisor = ShardSupervisor(app, num_workers=1)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(supervisor._poll())
+    assert supervisor.queues[0].get(timeout=1) == make_update(1, 42)
+
+
+class FakeWorker:
+    def __init__(self, alive, exits=True):
+        self.alive = alive
+        self.exits = exits  # on the stop marker
+        self.killed = False
+
+    def is_alive(self):
+        return self.alive and not self.killed
+
+    def join(self, timeout=None):
+        if self.exits:
+            self.alive = False
+
+    def kill(self):
+        self.killed = True
+
+
+def test_supervisor_stop_does_not_hang_on_full_queues(monkeypatch):
+    monkeypatch.setattr(sharding, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(sharding, "SHUTDOWN_TIMEOUT", 0.1)
+
+    async def close():
+        pass
+
+    app = SimpleNamespace(
+        logger=sharding.loguru.logger,
+        bot=SimpleNamespace(
+            _aiogram_bot=SimpleNamespace(session=SimpleNamespace(close=close))
+        ),
+    )
+    supervisor = ShardSupervisor(app, num_workers=3)
+    # a dead worker, a stuck one and a healthy one, all with full queues
+    for worker_queue in supervisor.queues[:2]:
+        worker_queue.put(make_update(1, 42))
+    dead, stuck, healthy = (
+        FakeWorker(False),
+        FakeWorker(True, exits=False),
+        FakeWorker(True),
+    )
+    supervisor.workers = [dead, stuck, healthy]
+    asyncio.run(asyncio.wait_for(supervisor.stop(), timeout=5))
+    assert stuck.killed and not healthy.killed
+    assert supervisor.queues[2].get(timeout=1) is None
@@ -0,0 +1,127 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bot_base.core import TelegramBot, TelegramBotConfig
+
+
+class FakeAiogramBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.fixture
+def bot():
+    # pyrogram client binds to the current event loop on creation
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    config = TelegramBotConfig(
+        token="1234567890:aaabbbcccdd-aaabbbcccdddeee_abcdefg",
+        progressive_edit_interval=0.05,
+    )
+    bot = TelegramBot(config)
+    bot._aiogram_bot = FakeAiogramBot()
+    return bot
+
+
+def test_send_progressively_throttles_edits(bot):
+    async def updates():
+        text = ""
+        for word in "one two three four five".split():
+            text += word + " "
+            yield text
+            await asyncio.sleep(0.01)
+
+    result = asyncio.run(bot.send_progressively(1, updates()))
+    fake = bot._aiogram_bot
+    assert result == "one two three four five "
+    assert len(fake.sent) == 1
+    assert fake.sent[0].startswith("one")
+    # 5 snapshots in ~50ms, but at most one edit per 50ms plus the final one
+    assert len(fake.edits) <= 3
+    assert fake.edits[-1] == result
+
+
+def test_send_progressively_propagates_errors(bot):
+    async def updates():
+        yield "partial"
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.send_progressively(1, updates()))
+
+
+def test_markdown_v2_is_repaired_before_sending(bot):
+    from aiogram.enums import ParseMode
+
+    asyncio.run(
+        bot._send_with_parse_mode_fallback(
+            1, "Total: *42* (approx.)", parse_mode=ParseMode.MARKDOWN_V2
+        )
+    )
+    assert bot._aiogram_bot.sent == ["Total: *42* \\(approx\\.\\)"]
+
+
+def test_send_safe_escaped_chunks_fit_the_limit(bot):
+    from bot_base.utils.text_utils import MAX_TELEGRAM_MESSAGE_LENGTH
+
+    bot.config.send_long_messages_as_files = False
+    text = "a.b " * 3000  # doubles in length when escaped
+    asyncio.run(bot.send_safe(text, 1, escape_markdown=True, wrap=False))
+    sent = bot._aiogram_bot.sent
+    assert all(len(chunk) <= MAX_TELEGRAM_MESSAGE_LENGTH for chunk in sent)
+    assert "".join(sent) == text.replace(".", "\\.")
+
+
+def test_silence_aware_transcripts_are_stitched(bot):
+    # no pause at the cut - the chunks overlap by the buffer
+    chunks = [
+        "we should move the release to the next week because",
+        "release to the next week because the tests fail",
+    ]
+
+    async def process_voice_message(message):
+        return chunks
+
+    bot._process_voice_message = process_voice_message
+    bot.app = SimpleNamespace(config=SimpleNamespace(split_audio_on_silence=True))
+    message = SimpleNamespace(
+        text=None, caption=None, voice=object(), audio=None, document=None
+    )
+    assert asyncio.run(bot._extract_message_text(message)) == (
+        "we should move the release to the next week because the tests fail"
+    )
+
+
+def test_concurrent_in_memory_downloads_share_one(bot):
+    downloads = []
+
+    class FakeDownloader:
+        async def download(self, message, file_path):
+            downloads.append(file_path)
+            await asyncio.sleep(0.01)
+            file_path.write_bytes(b"voice")
+
+    bot._get_parallel_downloader = lambda client: FakeDownloader()
+    message = SimpleNamespace(
+        audio=SimpleNamespace(file_unique_id="same", file_name=None)
+    )
+
+    async def main():
+        return await asyncio.gather(
+            bot._download_in_parts(None, message),
+            bot._download_in_parts(None, message),
+        )
+
+    first, second = asyncio.run(main())
+    assert len(downloads) == 1
+    assert first.read() == second.read() == b"voice"
+    assert not downloads[0].exists()
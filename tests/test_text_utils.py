@@ -1,6 +1,19 @@
 import pytest
 
-from bot_base.utils.text_utils import escape_md
+import itertools
+import random
+
+from bot_base.utils import text_utils
+from bot_base.utils.text_utils import (
+    escape_md,
+    find_markdown_v2_error,
+    iter_split_long_message,
+    prepare_markdown_v2,
+    reject_markdown_v2,
+    repair_markdown_v2,
+    split_long_message,
+    stitch_transcripts,
+)
 
 
 @pytest.mark.parametrize(
@@ -14,3 +27,152 @@ from bot_base.utils.text_utils import escape_md
 )
 def test_escape_md(text, escaped_text):
     assert escape_md(text) == escaped_text
+
+
+def make_overlapping_chunks(words, chunk_size=300, overlap=15, seed=0):
+    rng = random.Random(seed)
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = min(start + chunk_size, len(words))
+        chunk = words[start:end]
+        if end < len(words):
+            # whisper often mangles the word cut in the middle
+            chunk = chunk[:-1] + [chunk[-1][: rng.randint(1, 3)]]
+        chunks.append(" ".join(chunk))
+        if end == len(words):
+            break
+        start = end - overlap
+    return chunks
+
+
+def test_stitch_transcripts_removes_overlap():
+    rng = random.Random(42)
+    vocabulary = [f"word{i}" for i in range(500)]
+    words = [rng.choice(vocabulary) for _ in range(5000)]
+    chunks = make_overlapping_chunks(words)
+    assert stitch_transcripts(chunks) == " ".join(words)
+
+
+def test_stitch_transcripts_without_overlap():
+    chunks = ["First part of the text.", "Second part, nothing in common."]
+    assert stitch_transcripts(chunks) == "\n\n".join(chunks)
+
+
+def test_stitch_transcripts_keeps_common_phrases():
+    chunks = [
+        "Yesterday I told the team that I think we should move the release "
+        "to next week, because the payment integration still fails.",
+        "On the other hand, I think we should keep the date and ship "
+        "without the integration, then add it in a patch release.",
+    ]
+    assert stitch_transcripts(chunks) == "\n\n".join(chunks)
+
+
+def test_stitch_transcripts_tolerates_garbled_edges():
+    left = "we should move the release to the next wee"
+    right = "release to the next week because the tests fail"
+    assert stitch_transcripts([left, right]) == (
+        "we should move the release to the next week because the tests fail"
+    )
+
+
+def test_split_long_message_prefers_sep():
+    text = "aaaa\nbbbb\ncccc"
+    assert split_long_message(text, max_length=10) == ["aaaa\nbbbb\n", "cccc"]
+    assert "".join(split_long_message("x" * 25, max_length=10)) == "x" * 25
+
+
+def test_split_long_message_keeps_escape_sequences():
+    text = escape_md("a.b.c.d.e.f.g.h")
+    chunks = split_long_message(text, max_length=4, sep=None)
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    assert not any(chunk.endswith("\\") for chunk in chunks)
+
+
+def test_split_long_message_moves_code_block_whole():
+    text = "intro line\n```\ncode\n```\n"
+    chunks = split_long_message(text, max_length=16)
+    assert chunks == ["intro line\n", "```\ncode\n```\n"]
+
+
+def test_split_long_message_reopens_long_code_block():
+    code = "".join(f"line {i}\n" for i in range(20))
+    text = f"```python\n{code}```\n"
+    chunks = split_long_message(text, max_length=40)
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    for chunk in chunks:
+        assert chunk.count("```") % 2 == 0
+    assert all(chunk.startswith("```python\n") for chunk in chunks)
+    lines = "".join(chunks).split("\n")
+    assert [line for line in lines if line.startswith("line")] == code.split("\n")[:-1]
+
+
+def test_split_long_message_long_fence_line_makes_progress():
+    code = "".join(f"line {i}\n" for i in range(20))
+    text = f"```{'x' * 50}\n{code}```\n"
+    chunks = list(itertools.islice(iter_split_long_message(text, max_length=40), 100))
+    assert len(chunks) < 100
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    for chunk in chunks:
+        assert chunk.count("```") % 2 == 0
+
+
+def test_split_long_message_rejects_tiny_max_length():
+    with pytest.raises(ValueError):
+        split_long_message("```\ncode\n```" * 3, max_length=8)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "plain text",
+        "*bold* _italic_ __underline__ ~strike~ ||spoiler||",
+        "*bold _nested_ bold*",
+        "[link](https://example.com/a\\)b)",
+        "`inline. code` and ```\nblock (code).\n```",
+        "> quote\nescaped \\. dot",
+    ],
+)
+def test_find_markdown_v2_error_valid(text):
+    assert find_markdown_v2_error(text) is None
+
+
+@pytest.mark.parametrize(
+    "text, position",
+    [
+        ("end.", 3),
+        ("*unclosed", 0),
+        ("*a _b* c_", 5),
+        ("[text] no url", 5),
+        ("trailing \\", 9),
+        ("```\nunclosed block", 0),
+    ],
+)
+def test_find_markdown_v2_error_invalid(text, position):
+    assert find_markdown_v2_error(text) == position
+
+
+def test_repair_markdown_v2():
+    text = "Result: *42* (approx.)"
+    repaired = repair_markdown_v2(text)
+    assert repaired == "Result: *42* \\(approx\\.\\)"
+    assert find_markdown_v2_error(repaired) is None
+    assert repair_markdown_v2("." * 100, max_repairs=10) is None
+
+
+def test_prepare_markdown_v2_memoizes_templates(monkeypatch):
+    assert prepare_markdown_v2("Hello, *Alice*!") == "Hello, *Alice*\\!"
+    calls = []
+    monkeypatch.setattr(
+        text_utils,
+        "repair_markdown_v2",
+        lambda text: calls.append(text) or text,
+    )
+    # same template, different words - the outcome is known
+    assert prepare_markdown_v2("Hello, *Bob*") == "Hello, *Bob*"
+    assert prepare_markdown_v2("Bye, *Bob*") == "Bye, *Bob*"
+    assert calls == ["Hello, *Bob*"]
+    reject_markdown_v2("Bye, *Carol*")
+    assert prepare_markdown_v2("Bye, *Dave*") is None
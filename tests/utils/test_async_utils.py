@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from bot_base.utils.async_utils import FairScheduler, SingleFlight
+
+
+def test_fair_scheduler_takes_turns():
+    order = []
+
+    async def job(name):
+        await asyncio.sleep(0)
+        order.append(name)
+        return name
+
+    async def main():
+        scheduler = FairScheduler(max_concurrency=1)
+        long_upload = [scheduler.run("a", job, f"a{i}") for i in range(5)]
+        voice_note = scheduler.run("b", job, "b0")
+        return await asyncio.gather(*long_upload, voice_note)
+
+    results = asyncio.run(main())
+    assert results == ["a0", "a1", "a2", "a3", "a4", "b0"]
+    assert order.index("b0") <= 2
+
+
+def test_fair_scheduler_limits_concurrency():
+    running = 0
+    max_running = 0
+
+    async def job():
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def main():
+        scheduler = FairScheduler(max_concurrency=3, max_queue_per_key=2)
+        await asyncio.gather(*(scheduler.run(i % 2, job) for i in range(10)))
+
+    asyncio.run(main())
+    assert max_running == 3
+
+
+def test_fair_scheduler_cancellation():
+    started = []
+
+    async def job(name):
+        started.append(name)
+        await asyncio.sleep(1)
+
+    async def main():
+        scheduler = FairScheduler(max_concurrency=1)
+        running = asyncio.create_task(scheduler.run("a", job, "running"))
+        queued = asyncio.create_task(scheduler.run("a", job, "queued"))
+        await asyncio.sleep(0.01)
+        running.cancel()
+        queued.cancel()
+        for task in (running, queued):
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        await asyncio.sleep(0)
+        return scheduler
+
+    scheduler = asyncio.run(main())
+    assert started == ["running"]
+    assert scheduler.running == 0
+    assert scheduler.queued() == 0
+
+
+def test_single_flight_shares_call():
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(
+            flights.run("a", fetch, "a"),
+            flights.run("a", fetch, "a"),
+            flights.run("b", fetch, "b"),
+        )
+        return results, len(flights)
+
+    results, in_flight = asyncio.run(main())
+    assert results == ["aa", "aa", "bb"]
+    assert calls == ["a", "b"]
+    assert in_flight == 0
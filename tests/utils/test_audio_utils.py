@@ -0,0 +1,133 @@
+import asyncio
+import shutil
+
+import pytest
+
+import numpy as np
+
+from bot_base.utils.audio_utils import (
+    DEFAULT_BUFFER,
+    DEFAULT_PERIOD,
+    ENERGY_WINDOW,
+    get_encoding_executor,
+    get_max_chunk_period,
+    plan_chunks,
+    plan_chunks_on_silence,
+    shutdown_encoding_executor,
+)
+
+requires_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg is required"
+)
+requires_ffprobe = pytest.mark.skipif(
+    shutil.which("ffprobe") is None, reason="ffprobe is required"
+)
+
+
+def test_plan_chunks():
+    boundaries = plan_chunks(300 * 1000)
+    assert boundaries[0] == (0, DEFAULT_PERIOD)
+    assert boundaries[1][0] == DEFAULT_PERIOD - DEFAULT_BUFFER
+    assert boundaries[-1][1] == 300 * 1000
+
+
+def test_plan_chunks_short_audio():
+    assert plan_chunks(1000) == [(0, 1000)]
+
+
+def test_plan_chunks_on_silence():
+    # 5 minutes of speech with a pause at 1:50 and at 3:40
+    energy = np.full(300 * 1000 // ENERGY_WINDOW, 1000.0)
+    for pause in (110, 220):
+        energy[pause * 1000 // ENERGY_WINDOW] = 0
+    boundaries = plan_chunks_on_silence(
+        energy, period=DEFAULT_PERIOD, duration=300 * 1000
+    )
+    assert boundaries == [(0, 110_000), (110_000, 220_000), (220_000, 300_000)]
+
+
+def test_plan_chunks_on_silence_fills_the_upload_limit():
+    # an hour of speech with a pause every 10 seconds
+    energy = np.full(3600 * 1000 // ENERGY_WINDOW, 1000.0)
+    energy[:: 10 * 1000 // ENERGY_WINDOW] = 0
+    boundaries = plan_chunks_on_silence(energy)
+    max_period = get_max_chunk_period()
+    assert all(end - start <= max_period for start, end in boundaries)
+    # cut at the last pause before the limit, ~24.5 minutes
+    assert boundaries[0] == (0, 1470 * 1000)
+    assert len(boundaries) == 3
+
+
+def test_plan_chunks_on_silence_without_pauses():
+    energy = np.full(300 * 1000 // ENERGY_WINDOW, 1000.0)
+    boundaries = plan_chunks_on_silence(energy, period=DEFAULT_PERIOD)
+    assert boundaries == plan_chunks(300 * 1000)
+
+
+def test_encoding_executor_spawns_workers():
+    executor = get_encoding_executor(max_workers=1)
+    try:
+        assert executor._mp_context.get_start_method() == "spawn"
+        assert get_encoding_executor() is executor
+    finally:
+        shutdown_encoding_executor()
+    assert get_encoding_executor(max_workers=1) is not executor
+    shutdown_encoding_executor()
+
+
+@requires_ffmpeg
+@requires_ffprobe
+def test_iter_split_audio(tmp_path):
+    from pydub import AudioSegment
+    from pydub.generators import Sine
+
+    from bot_base.utils.audio_utils import iter_split_audio
+
+    path = tmp_path / "tone.mp3"
+    Sine(440).to_audio_segment(duration=25 * 1000).export(path, format="mp3")
+
+    chunks = list(iter_split_audio(str(path), period=10 * 1000, buffer=1000))
+    assert len(chunks) == 3
+    durations = [len(AudioSegment.from_file(chunk)) for chunk in chunks]
+    assert durations[0] == pytest.approx(10 * 1000, abs=100)
+
+
+@requires_ffmpeg
+def test_aiter_split_audio_keeps_order():
+    from pydub.generators import Sine
+
+    from bot_base.utils.audio_utils import aiter_split_audio
+
+    audio = Sine(440).to_audio_segment(duration=25 * 1000)
+
+    async def collect():
+        return [
+            chunk
+            async for chunk in aiter_split_audio(
+                audio, period=10 * 1000, buffer=1000, max_workers=2
+            )
+        ]
+
+    chunks = asyncio.run(collect())
+    assert [chunk.name for chunk in chunks] == [f"chunk_{i}.mp3" for i in range(3)]
+
+
+@requires_ffmpeg
+def test_split_and_transcribe_audio_pipelined(monkeypatch):
+    from pydub.generators import Sine
+
+    from bot_base.utils import audio_utils
+
+    async def fake_transcribe(chunk, duration=None):
+        await asyncio.sleep(0.01 * (3 - int(chunk.name[6])))  # finish out of order
+        return chunk.name
+
+    monkeypatch.setattr(audio_utils, "atranscribe_audio", fake_transcribe)
+    audio = Sine(440).to_audio_segment(duration=25 * 1000)
+
+    texts = asyncio.run(
+        audio_utils.split_and_transcribe_audio(
+            audio, period=10 * 1000, buffer=1000, parallel=True, pipelined=True
+        )
+    )
+    assert texts == [f"chunk_{i}.mp3" for i in range(3)]
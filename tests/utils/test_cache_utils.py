@@ -0,0 +1,61 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bot_base.utils.cache_utils import (
+    LRUCache,
+    MongoCache,
+    ThreadSafeLRUCache,
+    TieredCache,
+)
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+def test_lru_cache_ttl(monkeypatch):
+    cache = LRUCache(ttl=10)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    monkeypatch.setattr("time.monotonic", lambda: float("inf"))
+    assert cache.get("a") is None
+
+
+def test_thread_safe_lru_cache_concurrent_eviction():
+    cache = ThreadSafeLRUCache(max_size=8)
+
+    def hammer(offset):
+        for i in range(20_000):
+            cache.set(offset + i % 16, i)
+            cache.get(offset + (i + 1) % 16)
+
+    with ThreadPoolExecutor(4) as executor:
+        # evictions from other threads interleave with get and set
+        list(executor.map(hammer, [0, 4, 8, 12]))
+    assert len(cache) == 8
+
+
+def test_mongo_cache(mongo_db):
+    cache = MongoCache("test", max_size=2, ttl=60)
+    for i in range(3):
+        cache.set(f"key_{i}", [f"text_{i}"])
+    assert cache.get("key_2") == ["text_2"]
+    cache.evict()
+    assert cache._objects().count() == 2
+
+
+def test_tiered_cache_promotes_persistent_hits(mongo_db):
+    persistent = MongoCache("test")
+    persistent.set("key", "value")
+    cache = TieredCache(LRUCache(), persistent)
+    assert asyncio.run(cache.aget("key")) == "value"
+    assert cache.memory.get("key") == "value"
@@ -0,0 +1,127 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+
+from bot_base.utils import download_utils
+from bot_base.utils.download_utils import (
+    PYROGRAM_CHUNK_SIZE,
+    ParallelDownloader,
+    split_into_parts,
+)
+
+FILE_SIZE = 5 * PYROGRAM_CHUNK_SIZE + 123
+PART_SIZE = 2 * PYROGRAM_CHUNK_SIZE
+DATA = bytes(i % 251 for i in range(FILE_SIZE))
+
+
+class FakeSession:
+    """
+    Stands in for pyrogram's Session, serves DATA
+    """
+
+    fail_on_offset = None
+
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media=False):
+        self.requested_offsets = []  # pyrogram chunks
+        client.sessions.append(self)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def invoke(self, query, sleep_threshold=None):
+        if isinstance(query, raw.functions.auth.ImportAuthorization):
+            return None
+        offset = query.offset // PYROGRAM_CHUNK_SIZE
+        self.requested_offsets.append(offset)
+        if offset == self.fail_on_offset:
+            raise ConnectionError("Connection lost")
+        await asyncio.sleep(0)
+        return raw.types.upload.File(
+            type=raw.types.storage.FileUnknown(),
+            mtime=0,
+            bytes=DATA[query.offset : query.offset + query.limit],
+        )
+
+
+class FakeAuth:
+    def __init__(self, client, dc_id, test_mode):
+        pass
+
+    async def create(self):
+        return b"key"
+
+
+class FakeClient:
+    def __init__(self, home_dc_id=1):
+        self.sessions = []
+        self.exported = 0
+
+        async def value(result):
+            return result
+
+        self.storage = SimpleNamespace(
+            test_mode=lambda: value(False),
+            dc_id=lambda: value(home_dc_id),
+            auth_key=lambda: value(b"home key"),
+        )
+
+    async def invoke(self, query):
+        self.exported += 1
+        return SimpleNamespace(id=1, bytes=b"auth")
+
+
+@pytest.fixture(autouse=True)
+def fake_pyrogram(monkeypatch):
+    monkeypatch.setattr(download_utils, "Session", FakeSession)
+    monkeypatch.setattr(download_utils, "Auth", FakeAuth)
+
+
+@pytest.fixture
+def message():
+    file_id = FileId(
+        file_type=FileType.AUDIO,
+        dc_id=2,
+        media_id=1,
+        access_hash=1,
+        file_reference=b"",
+    ).encode()
+    return SimpleNamespace(audio=SimpleNamespace(file_id=file_id, file_size=FILE_SIZE))
+
+
+def test_split_into_parts():
+    parts = split_into_parts(FILE_SIZE, PART_SIZE)
+    assert len(parts) == 3
+    assert [p.offset for p in parts] == [0, 2, 4]
+    assert sum(p.length for p in parts) == FILE_SIZE
+
+
+def test_parallel_download(tmp_path, message):
+    client = FakeClient()
+    downloader = ParallelDownloader(client, part_size=PART_SIZE)
+    target_path = asyncio.run(downloader.download(message, tmp_path / "file"))
+    assert target_path.read_bytes() == DATA
+    assert not (tmp_path / "file.parts").exists()
+    # all parts go over one media session, authorized once for the foreign DC
+    assert len(client.sessions) == 1
+    assert client.exported == 1
+
+
+def test_parallel_download_resume(tmp_path, message, monkeypatch):
+    monkeypatch.setattr(FakeSession, "fail_on_offset", 4)
+    downloader = ParallelDownloader(FakeClient(), concurrency=1, part_size=PART_SIZE)
+    with pytest.raises(ConnectionError):
+        asyncio.run(downloader.download(message, tmp_path / "file"))
+    assert (tmp_path / "file.parts").exists()
+
+    monkeypatch.setattr(FakeSession, "fail_on_offset", None)
+    client = FakeClient()
+    downloader = ParallelDownloader(client, part_size=PART_SIZE)
+    target_path = asyncio.run(downloader.download(message, tmp_path / "file"))
+    assert client.sessions[0].requested_offsets == [4, 5]
+    assert target_path.read_bytes() == DATA
@@ -0,0 +1,231 @@
+import asyncio
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+from bot_base.utils import gpt_utils
+from bot_base.utils.cache_utils import LRUCache, TieredCache
+
+
+class WhitespaceEncoding:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+    def encode_batch(self, texts, num_threads=8):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    encoding = WhitespaceEncoding()
+    monkeypatch.setattr(gpt_utils, "get_encoding", lambda model: encoding)
+    gpt_utils._token_count_cache.clear()
+    yield encoding
+    gpt_utils._token_count_cache.clear()
+
+
+def test_get_token_count_is_cached(encoding):
+    assert gpt_utils.get_token_count("one two three") == 3
+    assert gpt_utils.get_token_count("one two three") == 3
+    assert encoding.encoded == ["one two three"]
+
+
+def test_get_token_counts_only_encodes_missing(encoding):
+    gpt_utils.get_token_count("a b")
+    counts = gpt_utils.get_token_counts(["a b", "c d e", "f"])
+    assert counts == [2, 3, 1]
+    assert encoding.encoded == ["a b", "c d e", "f"]
+
+
+@pytest.fixture
+def fake_gpt(monkeypatch, encoding):
+    calls = []
+
+    async def arun_command_with_gpt(command, data, model="gpt-3.5-turbo"):
+        calls.append(data)
+        await asyncio.sleep(0.001 * (len(calls) % 3))  # finish out of order
+        return f"merged{len(calls)}"
+
+    monkeypatch.setattr(gpt_utils, "arun_command_with_gpt", arun_command_with_gpt)
+    monkeypatch.setitem(gpt_utils.token_limit_by_model, "test", 5)
+    monkeypatch.setattr(gpt_utils, "MAP_REDUCE_RETRY_DELAY", 0)
+    return calls
+
+
+def test_map_reduce_builds_a_tree(fake_gpt):
+    progress = []
+    chunks = [f"word{i} word{i}" for i in range(10)]
+    result = asyncio.run(
+        gpt_utils.amap_reduce_gpt_command(
+            "summarize",
+            chunks,
+            model="test",
+            merger=" ".join,
+            on_progress=lambda done, started: progress.append(done),
+        )
+    )
+    # 10 chunks -> 5 groups of 2 -> 1 group of 5
+    assert len(fake_gpt) == 6
+    assert fake_gpt[:5] == [" ".join(chunks[i : i + 2]) for i in range(0, 10, 2)]
+    assert result == "merged6"
+    assert progress == [1, 2, 3, 4, 5, 6]
+
+
+def test_map_reduce_single_chunk(fake_gpt):
+    result = asyncio.run(gpt_utils.amap_reduce_gpt_command("cmd", ["a"], model="test"))
+    assert result == "a"
+    assert fake_gpt == []
+
+
+def test_map_reduce_no_chunks(fake_gpt):
+    with pytest.raises(ValueError):
+        asyncio.run(
+            asyncio.wait_for(
+                gpt_utils.amap_reduce_gpt_command("cmd", [], model="test"), timeout=1
+            )
+        )
+
+
+def test_map_reduce_tokenizes_chunks_in_one_batch(fake_gpt, encoding, monkeypatch):
+    batches = []
+    encode_batch = encoding.encode_batch
+
+    def record_batch(texts, num_threads=8):
+        batches.append(list(texts))
+        return encode_batch(texts, num_threads=num_threads)
+
+    monkeypatch.setattr(encoding, "encode_batch", record_batch)
+    chunks = [f"word{i} word{i}" for i in range(10)]
+    asyncio.run(gpt_utils.amap_reduce_gpt_command("cmd", chunks, model="test"))
+    assert batches == [chunks]
+    # node results are tokenized as they arrive
+    assert all(text.startswith("merged") for text in encoding.encoded[10:])
+
+
+def test_map_reduce_retries_failed_node(fake_gpt, monkeypatch):
+    failures = []
+
+    async def flaky(command, data, model="gpt-3.5-turbo"):
+        if not failures:
+            failures.append(data)
+            raise RuntimeError("rate limited")
+        return "done"
+
+    monkeypatch.setattr(gpt_utils, "arun_command_with_gpt", flaky)
+    result = asyncio.run(
+        gpt_utils.amap_reduce_gpt_command("cmd", ["a b", "c d"], model="test")
+    )
+    assert result == "done"
+    assert len(failures) == 1
+
+
+def test_map_reduce_item_too_big(fake_gpt):
+    with pytest.raises(ValueError):
+        asyncio.run(
+            gpt_utils.amap_reduce_gpt_command("cmd", ["a b c d e f", "g"], model="test")
+        )
+    assert fake_gpt == []
+
+
+@pytest.fixture
+def fake_openai(monkeypatch, encoding):
+    calls = []
+
+    async def acreate(messages, model):
+        calls.append(messages[1]["content"])
+        await asyncio.sleep(0.01)
+        message = SimpleNamespace(content=f"answer to {messages[1]['content']}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(gpt_utils.openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(
+        gpt_utils, "completion_cache", TieredCache(LRUCache(max_size=10))
+    )
+    return calls
+
+
+def test_completion_cache_deduplicates_calls(fake_openai):
+    async def main():
+        first = await asyncio.gather(
+            gpt_utils.arun_command_with_gpt("cmd", "a"),
+            gpt_utils.arun_command_with_gpt("cmd", "a"),
+            gpt_utils.arun_command_with_gpt("cmd", "b"),
+        )
+        second = await gpt_utils.arun_command_with_gpt("cmd", "a")
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == ["answer to a", "answer to a", "answer to b"]
+    assert second == "answer to a"
+    assert fake_openai == ["a", "b"]
+
+
+def test_completion_cache_can_be_skipped(fake_openai):
+    async def main():
+        await gpt_utils.arun_command_with_gpt("cmd", "a")
+        await gpt_utils.arun_command_with_gpt("cmd", "a", use_cache=False)
+        await gpt_utils.arun_command_with_gpt("other cmd", "a")
+
+    asyncio.run(main())
+    assert fake_openai == ["a", "a", "a"]
+
+
+def test_aiter_map_gpt_command_streams_tokens(monkeypatch):
+    async def astream_command_with_gpt(command, data, model="gpt-3.5-turbo"):
+        for token in ["a", "b", "c"]:
+            yield token
+
+    monkeypatch.setattr(gpt_utils, "astream_command_with_gpt", astream_command_with_gpt)
+
+    async def collect():
+        return [
+            text
+            async for text in gpt_utils.aiter_map_gpt_command(
+                ["chunk1", "chunk2"], "cmd", stream_tokens=True
+            )
+        ]
+
+    assert asyncio.run(collect()) == ["a", "ab", "abc"] * 2
+
+
+def test_aiter_map_gpt_command_passes_temporary_results(fake_gpt):
+    async def collect():
+        return [
+            text async for text in gpt_utils.aiter_map_gpt_command(["x", "y"], "cmd")
+        ]
+
+    assert asyncio.run(collect()) == ["merged1", "merged2"]
+    assert '"TEMPORARY_RESULTS": "merged1"' in fake_gpt[1]
+
+
+def test_atranscribe_audio_retry_uploads_whole_file(monkeypatch):
+    uploaded = []
+
+    async def atranscribe(model, file):
+        uploaded.append(len(file.read()))
+        if len(uploaded) == 1:
+            raise gpt_utils.openai.error.RateLimitError(
+                "429", headers={"retry-after": "0"}
+            )
+        return SimpleNamespace(text="hello")
+
+    monkeypatch.setattr(gpt_utils.openai.Audio, "atranscribe", atranscribe)
+    audio = BytesIO(b"x" * 1000)
+    assert asyncio.run(gpt_utils.atranscribe_audio(audio)) == "hello"
+    assert uploaded == [1000, 1000]
+
+
+def test_without_completion_cache_every_call_is_made(fake_openai, monkeypatch):
+    monkeypatch.setattr(gpt_utils, "completion_cache", None)
+
+    async def main():
+        await gpt_utils.arun_command_with_gpt("cmd", "a")
+        await gpt_utils.arun_command_with_gpt("cmd", "a")
+
+    asyncio.run(main())
+    assert fake_openai == ["a", "a"]
@@ -1,11 +1,153 @@
+import io
+import json
+import time
+from datetime import datetime, timedelta
+
+import loguru
 import pytest
 
-from bot_base.utils.logging_utils import setup_logger
+from bot_base.utils.logging_utils import (
+    LogItem,
+    MongoLogSink,
+    _get_log_item_meta,
+    format_record,
+    format_record_json,
+    load_logs,
+    render_data,
+    setup_logger,
+)
 
 
 def test_setup_logger():
     setup_logger(log_to_stderr=True, log_to_file=True)
 
 
+@pytest.fixture
+def logger():
+    logger = loguru.logger
+    handler_ids = []
+    yield lambda sink: handler_ids.append(logger.add(sink, level="INFO"))
+    for handler_id in handler_ids:
+        logger.remove(handler_id)
+
+
+@pytest.fixture
+def patched_logger():
+    loguru.logger.configure(patcher=render_data)
+    yield loguru.logger
+    loguru.logger.configure(patcher=None)
+
+
+def test_render_data_once_for_all_sinks(logger, patched_logger):
+    text, json_lines = io.StringIO(), io.StringIO()
+    logger(text)  # default format - ignores data
+    handler_ids = [
+        patched_logger.add(text, level="INFO", format=format_record),
+        patched_logger.add(json_lines, level="INFO", format=format_record_json),
+    ]
+    calls = []
+
+    def data():
+        calls.append(1)
+        return "x" * 1000
+
+    patched_logger.info("big payload", data=data)
+    # no sink takes TRACE records - the data is never built
+    patched_logger.trace("discarded", data=data)
+    for handler_id in handler_ids:
+        patched_logger.remove(handler_id)
+
+    assert len(calls) == 1
+    assert "Data (Total length: 1000)" in text.getvalue()
+    item = json.loads(json_lines.getvalue())
+    assert item["message"] == "big payload"
+    assert item["data_length"] == 1000
+    assert item["data"] == "x" * 100 + "..."
+
+
+def test_mongo_log_sink_writes_in_batches(mongo_db, logger):
+    sink = MongoLogSink(batch_size=10, flush_interval=0.05)
+    logger(sink)
+    for i in range(25):
+        loguru.logger.bind(component="test", data={"i": i}).info(f"message {i}")
+    sink.stop()
+    assert LogItem.objects(component="test").count() == 25
+    assert LogItem.objects(message="message 3").first().data == "{'i': 3}"
+
+
+class BrokenLogItem:
+    @classmethod
+    def _get_collection(cls):
+        raise ConnectionError("mongo is down")
+
+
+def test_mongo_log_sink_spills_to_file(tmp_path, logger):
+    spill_path = tmp_path / "spill.jsonl"
+    sink = MongoLogSink(
+        flush_interval=0.01,
+        overflow="spill",
+        spill_path=str(spill_path),
+        document_class=BrokenLogItem,
+    )
+    logger(sink)
+    loguru.logger.bind(component="test").error("lost connection")
+    sink.stop()
+    lines = spill_path.read_text().splitlines()
+    assert json.loads(lines[0])["message"] == "lost connection"
+
+
+class SlowLogItem:
+    @classmethod
+    def _get_collection(cls):
+        time.sleep(0.2)  # waiting for an unreachable server
+        raise ConnectionError("mongo is down")
+
+
+def test_mongo_log_sink_stop_times_out(tmp_path, logger):
+    spill_path = tmp_path / "spill.jsonl"
+    sink = MongoLogSink(
+        batch_size=10,
+        overflow="spill",
+        spill_path=str(spill_path),
+        document_class=SlowLogItem,
+    )
+    logger(sink)
+    for i in range(100):
+        loguru.logger.bind(component="test").info(f"message {i}")
+    start = time.monotonic()
+    sink.stop(timeout=0.1)
+    assert time.monotonic() - start < 0.5
+    time.sleep(0.3)  # the batch being written when stop timed out
+    lines = spill_path.read_text().splitlines()
+    assert len(lines) == 100
+
+
+def test_load_logs_pagination(mongo_db):
+    start = datetime(2023, 1, 1)
+    for i in range(5):
+        # two items per timestamp - the cursor must not skip or repeat them
+        LogItem(timestamp=start + timedelta(seconds=i // 2), message=f"m{i}").save()
+    pages = [load_logs(limit=2, fields=["message"])]
+    while pages[-1]:
+        pages.append(load_logs(limit=2, cursor=pages[-1][-1], fields=["message"]))
+    messages = [item["message"] for page in pages for item in page]
+    assert sorted(messages) == [f"m{i}" for i in range(5)]
+    assert "level" not in pages[0][0]
+    assert (
+        "level_1_timestamp_-1__id_-1" in LogItem._get_collection().index_information()
+    )
+
+
+def test_log_item_retention(monkeypatch):
+    monkeypatch.setenv("LOG_RETENTION_DAYS", "7")
+    indexes = _get_log_item_meta()["indexes"]
+    assert {"fields": ["timestamp"], "expireAfterSeconds": 7 * 86400} in indexes
+
+    monkeypatch.setenv("LOG_CAPPED_SIZE_MB", "10")
+    meta = _get_log_item_meta()
+    assert meta["max_size"] == 10 * 1024 * 1024
+    assert not any(isinstance(index, dict) for index in meta["indexes"])
+
+
 if __name__ == "__main__":
     pytest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot_base.utils import outbound_utils
+from bot_base.utils.outbound_utils import (
+    OutboundQueue,
+    Priority,
+    RateLimiter,
+    TextInputFile,
+)
+
+
+def test_rate_limiter_serves_priority_first():
+    served = []
+
+    async def waiter(limiter, name, priority):
+        await limiter.acquire(priority)
+        served.append(name)
+
+    async def main():
+        limiter = RateLimiter(rate=100, burst=1)
+        await limiter.acquire()  # drain the bucket
+        await asyncio.gather(
+            waiter(limiter, "bulk", Priority.BULK),
+            waiter(limiter, "interactive", Priority.INTERACTIVE),
+        )
+
+    asyncio.run(main())
+    assert served == ["interactive", "bulk"]
+
+
+def test_outbound_queue_honors_retry_after():
+    calls = []
+
+    async def send(text):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=None, message="flood", retry_after=0.1)
+        return text
+
+    queue = OutboundQueue(chat_rate=1000, chat_burst=10)
+    result = asyncio.run(queue.send(1, send, "hi"))
+    assert result == "hi"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.1
+
+
+def test_outbound_queue_keeps_replies_together():
+    sent = []
+
+    async def send(text):
+        await asyncio.sleep(0)
+        sent.append(text)
+
+    async def reply(queue, name):
+        async with queue.ordered(1):
+            for i in range(3):
+                await queue.send(1, send, f"{name}{i}")
+
+    async def main():
+        queue = OutboundQueue(chat_rate=1000, chat_burst=10)
+        await asyncio.gather(reply(queue, "a"), reply(queue, "b"))
+
+    asyncio.run(main())
+    assert sent == ["a0", "a1", "a2", "b0", "b1", "b2"]
+
+
+def test_outbound_queue_drops_idle_chats(monkeypatch):
+    monkeypatch.setattr(outbound_utils, "IDLE_SWEEP_INTERVAL", 0)
+
+    async def send(text):
+        return text
+
+    async def main():
+        queue = OutboundQueue(chat_rate=1000, chat_burst=1)
+        for chat_id in range(100):
+            await queue.send(chat_id, send, "hi")
+        await asyncio.sleep(0.01)  # the buckets refill
+        async with queue.ordered(-1):
+            await queue.send(-1, send, "hi")
+            # the chat in use is kept, the idle ones are gone
+            assert set(queue._chat_locks) == {-1}
+            assert set(queue._chat_limiters) == {-1}
+
+    asyncio.run(main())
+
+
+def test_text_input_file_streams_chunks():
+    text = "привет, мир! " * 1000
+
+    async def collect(file):
+        return [chunk async for chunk in file.read(bot=None)]
+
+    chunks = asyncio.run(collect(TextInputFile(text, "reply.txt", chunk_size=1024)))
+    assert b"".join(chunks).decode("utf-8") == text
+    assert max(map(len, chunks)) < 2 * 1024
+
+    lines = (f"line {i}\n" for i in range(100))
+    chunks = asyncio.run(collect(TextInputFile(lines, "lines.txt", chunk_size=64)))
+    assert b"".join(chunks).decode("utf-8").count("\n") == 100
@@ -0,0 +1,67 @@
+import asyncio
+
+import openai
+import pytest
+
+from bot_base.utils.rate_limit_utils import (
+    ModelLimits,
+    ModelRateLimiter,
+    RateLimiterRegistry,
+    call_with_rate_limit,
+    get_retry_after,
+    parse_reset_duration,
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("1s", 1), ("6m0s", 360), ("20ms", 0.02), ("1h2m", 3720), ("2.5", 2.5)],
+)
+def test_parse_reset_duration(value, expected):
+    assert parse_reset_duration(value) == pytest.approx(expected)
+
+
+def test_get_retry_after_takes_longest_reset():
+    error = openai.error.RateLimitError(
+        "slow down",
+        headers={"Retry-After": "2", "x-ratelimit-reset-tokens": "6s"},
+    )
+    assert get_retry_after(error) == 6
+
+
+def test_registry_shares_limiters():
+    registry = RateLimiterRegistry({"gpt-4": ModelLimits(10, 100)})
+    assert registry.get("gpt-4") is registry.get("gpt-4")
+    assert registry.get("gpt-4").units.max_rate == 100
+    assert registry.get("unknown").units is None
+
+
+def test_call_with_rate_limit_retries_on_429():
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise openai.error.RateLimitError("429", headers={"retry-after": "0"})
+        return "ok"
+
+    limiter = ModelRateLimiter(ModelLimits(100, 1000))
+    result = asyncio.run(call_with_rate_limit(limiter, call, units=10))
+    assert result == "ok"
+    assert len(attempts) == 3
+
+
+def test_call_with_rate_limit_gives_up():
+    async def call():
+        raise openai.error.RateLimitError("429", headers={"retry-after": "0"})
+
+    limiter = ModelRateLimiter(ModelLimits(100))
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(call_with_rate_limit(limiter, call, max_retries=1))
+
+
+def test_registry_configure_raises_limits():
+    registry = RateLimiterRegistry()
+    assert registry.get("gpt-3.5-turbo").requests.max_rate == 200
+    registry.configure("gpt-3.5-turbo", ModelLimits(3500, 90_000))
+    assert registry.get("gpt-3.5-turbo").requests.max_rate == 3500
@@ -0,0 +1,96 @@
+import asyncio
+
+import aiogram
+from aiogram import types
+from aiohttp.test_utils import TestClient, TestServer
+
+from bot_base.utils.webhook_utils import SECRET_TOKEN_HEADER, WebhookServer
+
+TOKEN = "1234567890:aaabbbcccdd-aaabbbcccdddeee_abcdefg"
+
+# recorded from a real update
+UPDATE = {
+    "update_id": 10000,
+    "message": {
+        "message_id": 1365,
+        "date": 1441645532,
+        "chat": {"id": 1111111, "type": "private", "first_name": "Test"},
+        "from": {"id": 1111111, "is_bot": False, "first_name": "Test"},
+        "text": "hello",
+    },
+}
+
+
+def make_server(handled, **kwargs):
+    bot = aiogram.Bot(token=TOKEN)
+    dispatcher = aiogram.Dispatcher()
+
+    @dispatcher.message()
+    async def handler(message: types.Message):
+        await asyncio.sleep(0.05)
+        handled.append(message.text)
+
+    return WebhookServer(dispatcher, bot, **kwargs)
+
+
+def test_webhook_feeds_updates_and_drains():
+    handled = []
+
+    async def main():
+        server = make_server(handled, secret_token="secret")
+        async with TestClient(TestServer(server.make_app())) as client:
+            response = await client.post(
+                "/webhook", json=UPDATE, headers={SECRET_TOKEN_HEADER: "secret"}
+            )
+            assert response.status == 200
+        # closing the client shuts the app down, which waits for the handler
+
+    asyncio.run(main())
+    assert handled == ["hello"]
+
+
+def test_webhook_rejects_wrong_secret():
+    handled = []
+
+    async def main():
+        server = make_server(handled, secret_token="secret")
+        async with TestClient(TestServer(server.make_app())) as client:
+            response = await client.post(
+                "/webhook", json=UPDATE, headers={SECRET_TOKEN_HEADER: "wrong"}
+            )
+            assert response.status == 401
+            response = await client.post("/webhook", json=UPDATE)
+            assert response.status == 401
+            response = await client.post(
+                "/webhook", data="not json", headers={SECRET_TOKEN_HEADER: "secret"}
+            )
+            assert response.status == 400
+
+    asyncio.run(main())
+    assert handled == []
+
+
+def test_webhook_refuses_updates_while_draining():
+    async def main():
+        server = make_server([])
+        async with TestClient(TestServer(server.make_app())) as client:
+            await server.drain()
+            response = await client.post("/webhook", json=UPDATE)
+            assert response.status == 503
+
+    asyncio.run(main())
+
+
+def test_webhook_refuses_updates_when_busy():
+    handled = []
+
+    async def main():
+        server = make_server(handled, max_concurrent_updates=1)
+        async with TestClient(TestServer(server.make_app())) as client:
+            first = await client.post("/webhook", json=UPDATE)
+            second = await client.post("/webhook", json=UPDATE)
+            # acknowledged right away, not held until the slot is free
+            assert (first.status, second.status) == (200, 429)
+
+    asyncio.run(main())
+    assert handled == ["hello"]